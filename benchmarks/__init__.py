@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Lalf.
+#
+# Lalf is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Lalf is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Lalf.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Micro-benchmarks of Lalf, comparing the current implementation of some
+functions with the previous ones and with the alternatives which have
+been considered
+
+Each module can be run directly from the root of the repository, for
+example:
+
+    python3 -m benchmarks.escape
+"""
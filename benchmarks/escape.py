@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Lalf.
+#
+# Lalf is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Lalf is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Lalf.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Benchmark of the escaping of the bbcode (lalf.htmltobbcode.escape) and
+of the sql values (lalf.sql.escape)
+
+For each function, the current implementation is compared with the
+previous one and with a single pass implementation using str.translate,
+on ascii text, accented french text and text containing a lot of
+characters to escape.
+
+Usage:
+    python3 -m benchmarks.escape [repeat]
+"""
+
+import sys
+import timeit
+
+from lalf import htmltobbcode, sql
+
+BBCODE_REPLACEMENTS = {
+    '<': '&lt;',
+    '>': '&gt;',
+    '[': '&#91;',
+    ']': '&#93;',
+    '.': '&#46;',
+    ':': '&#58;'
+}
+BBCODE_TABLE = str.maketrans(BBCODE_REPLACEMENTS)
+
+SQL_TABLE = str.maketrans({"\\": "\\\\", "'": "''"})
+
+INPUTS = [
+    ("ascii", "The quick brown fox jumps over the lazy dog " * 9),
+    ("french", "Voilà un été où l'élève a reçu ses œuvres complètes, à côté du château " * 5),
+    ("markup", "[b]http://www.example.com/a.b:c[/b] <x> 1.2.3: l'a\\b " * 7),
+    ("url", "http://www.example.com/forum/viewtopic.php?t=12&p=34"),
+    ("short", "Toto"),
+]
+
+def old_bbcode_escape(string):
+    """
+    Previous implementation of htmltobbcode.escape
+    """
+    for key, value in BBCODE_REPLACEMENTS.items():
+        string = string.replace(key, value)
+    return string
+
+def translate_bbcode_escape(string):
+    """
+    Single pass implementation of htmltobbcode.escape
+    """
+    return string.translate(BBCODE_TABLE)
+
+def old_sql_escape(string):
+    """
+    Previous implementation of sql.escape
+    """
+    return string.replace("\\", "\\\\").replace("'", "''")
+
+def translate_sql_escape(string):
+    """
+    Single pass implementation of sql.escape
+    """
+    return string.translate(SQL_TABLE)
+
+BENCHMARKS = [
+    ("htmltobbcode.escape", [old_bbcode_escape, translate_bbcode_escape, htmltobbcode.escape]),
+    ("sql.escape", [old_sql_escape, translate_sql_escape, sql.escape]),
+]
+
+def measure(function, string, repeat):
+    """
+    Returns the best time of a call to function(string), in microseconds
+    """
+    timer = timeit.Timer(lambda: function(string))
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number * 1e6
+
+def main(repeat=9):
+    """
+    Print the time of a call to each implementation, for each input
+    """
+    print("Temps par appel (µs, meilleur de {}) : ancienne / translate / actuelle".format(repeat))
+    for name, functions in BENCHMARKS:
+        print()
+        print(name)
+        for label, string in INPUTS:
+            results = {function(string) for function in functions}
+            if len(results) != 1:
+                raise AssertionError("Résultats différents pour l'entrée {}".format(label))
+
+            times = [measure(function, string, repeat) for function in functions]
+            print("  {:8} {:4d} | {}".format(
+                label, len(string), "  ".join("{:6.2f}".format(time) for time in times)))
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
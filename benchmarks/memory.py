@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Lalf.
+#
+# Lalf is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Lalf is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Lalf.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Benchmark of the memory used by the posts of the exported tree
+
+The current nodes (which define __slots__ and share the scope of their
+parent) are compared with a copy of the previous implementation, where
+each node had a __dict__, its own logger reference, a list of children
+and a private copy of the exposed attributes. The posts are added to a
+page of a topic, like during the export, and measured with tracemalloc.
+
+Usage:
+    python3 -m benchmarks.memory [posts]
+"""
+
+import logging
+import pickle
+import sys
+import time
+import tracemalloc
+
+from lalf.topics import Topic
+from lalf.posts import TopicPage, Post
+
+class OldNode(object):
+    """
+    Previous implementation of lalf.node.Node (without __slots__)
+    """
+    NODE_KEEP = ["children", "exposed_attrs", "exported"]
+    STATE_KEEP = []
+    EXPOSE = []
+
+    def __init__(self):
+        self.logger = logging.getLogger("{}.{}".format(self.__class__.__module__,
+                                                       self.__class__.__name__))
+
+        self.children = []
+        self.exposed_attrs = {}
+
+        self.exported = False
+
+    def add_child(self, child):
+        """
+        Add a child to the node
+        """
+        self.children.append(child)
+
+        child.exposed_attrs.update(self.exposed_attrs)
+        for attr, name in self.__class__.EXPOSE:
+            child.exposed_attrs[name] = (self, attr)
+
+    def __getstate__(self):
+        odict = self.__dict__.copy()
+
+        for k in self.__dict__:
+            if not (k in self.NODE_KEEP or k in self.STATE_KEEP):
+                del odict[k]
+
+        return odict
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+class OldTopic(OldNode):
+    """
+    Previous implementation of lalf.topics.Topic
+    """
+    STATE_KEEP = ["topic_id", "topic_type", "title", "locked", "views"]
+    EXPOSE = [("self", "topic")]
+
+    def __init__(self, topic_id, topic_type, title, locked, views):
+        OldNode.__init__(self)
+        self.topic_id = topic_id
+        self.topic_type = topic_type
+        self.title = title
+        self.locked = locked
+        self.views = views
+
+class OldTopicPage(OldNode):
+    """
+    Previous implementation of lalf.posts.TopicPage
+    """
+    STATE_KEEP = ["page", "html"]
+
+    def __init__(self, page, html=None):
+        OldNode.__init__(self)
+        self.page = page
+        self.html = html
+
+class OldPost(OldNode):
+    """
+    Previous implementation of lalf.posts.Post
+    """
+    STATE_KEEP = ["post_id", "text", "title", "time", "poster"]
+
+    def __init__(self, post_id, text, title, post_time, poster):
+        OldNode.__init__(self)
+        self.post_id = post_id
+        self.text = text
+        self.title = title
+        self.time = post_time
+        self.poster = poster
+
+IMPLEMENTATIONS = [
+    ("ancienne", OldTopic, OldTopicPage, OldPost),
+    ("actuelle", Topic, TopicPage, Post),
+]
+
+def measure(topic_class, page_class, post_class, count):
+    """
+    Returns the memory used by each post (in bytes), the time needed to
+    create it (in microseconds) and the size of its pickled state (in
+    bytes)
+    """
+    poster = object()
+    topic = topic_class(1, 0, "Sujet", 0, 0)
+    page = page_class(0)
+    topic.add_child(page)
+
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    timer = time.perf_counter()
+    for post_id in range(count):
+        # The content of the posts is moved to the store (see use_sqlite)
+        page.add_child(post_class(post_id, None, "Sujet", 1421024400 + post_id, poster))
+    elapsed = time.perf_counter() - timer
+    used = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+
+    size = len(pickle.dumps(page, 2))
+    return used / count, elapsed / count * 1e6, size / count
+
+def main(count=100000):
+    """
+    Print the memory used by a post with each implementation
+    """
+    print("Par message ({} messages) : mémoire, temps de création, taille sauvegardée".format(
+        count))
+    for label, topic_class, page_class, post_class in IMPLEMENTATIONS:
+        memory, duration, size = measure(topic_class, page_class, post_class, count)
+        print("  {:9} {:6.0f} octets  {:6.2f} µs  {:4.0f} octets".format(
+            label, memory, duration, size))
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
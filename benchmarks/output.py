@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Lalf.
+#
+# Lalf is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Lalf is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Lalf.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Benchmark of the writing of the dump file (lalf.sql.open_output)
+
+The writer previously used (codecs.open) is compared with the buffered
+writer of open_output, without compression and with gzip and zstd (if
+available), on the insert statements of generated posts written one
+by one, and through SqlFile.insert (escaping and formatting included).
+
+Usage:
+    python3 -m benchmarks.output [posts]
+"""
+
+import codecs
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from lalf.sql import SqlFile, EXTENSIONS, open_output
+
+WORDS = ("le la les un une des et à de du en pour que qui dans sur avec pas plus "
+         "forum message sujet réponse été élève château œuvre première déjà très "
+         "[b] [/b] [url] [/url] http://www.example.com/ :) l'image n'est").split()
+
+def generate_posts(count):
+    """
+    Returns rows of the posts table with random french text
+    """
+    generator = random.Random(0)
+    posts = []
+    for post_id in range(count):
+        posts.append({
+            "post_id": post_id,
+            "topic_id": post_id // 20,
+            "forum_id": 1,
+            "poster_id": generator.randrange(1000),
+            "post_time": 1421024400 + post_id,
+            "poster_ip": "::1",
+            "post_subject": "Re: " + " ".join(generator.choices(WORDS, k=5)),
+            "post_text": " ".join(generator.choices(WORDS, k=generator.randrange(20, 300))),
+            "bbcode_bitfield": "QQ==",
+            "bbcode_uid": "abcdefgh"})
+    return posts
+
+def available_compressions():
+    """
+    Returns the compressions which can be used (zstd may not be available)
+    """
+    compressions = []
+    for compression in EXTENSIONS:
+        try:
+            with tempfile.TemporaryDirectory() as directory:
+                open_output(os.path.join(directory, "test"), compression).close()
+        except ImportError:
+            continue
+        compressions.append(compression)
+    return compressions
+
+def measure(write, path, repeat=3):
+    """
+    Returns the best time of write(path), in seconds, and the size of
+    the written file
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        write(path)
+        duration = time.perf_counter() - start
+        best = duration if best is None else min(best, duration)
+    return best, os.path.getsize(path)
+
+def write_lines(fileobj, lines):
+    """
+    Write the lines one by one, then close the file
+    """
+    with fileobj:
+        for line in lines:
+            fileobj.write(line)
+
+def write_rows(sqlfile, posts):
+    """
+    Insert the rows with SqlFile.insert, then close the file
+    """
+    with sqlfile:
+        for post in posts:
+            sqlfile.insert("posts", post)
+
+def main(count=20000):
+    """
+    Print the throughput of each writer
+    """
+    posts = generate_posts(count)
+    directory = tempfile.mkdtemp()
+    try:
+        # Statements of the posts, with one row each
+        path = os.path.join(directory, "lines.sql")
+        write_rows(SqlFile(path, "phpbb_", 0), posts)
+        with open(path, encoding="utf-8", newline="") as fileobj:
+            lines = fileobj.readlines()
+        size = os.path.getsize(path)
+        megabytes = size / 1024 / 1024
+
+        writers = [("codecs", lambda path: codecs.open(path, "w", "utf-8"))]
+        for compression in available_compressions():
+            writers.append((compression, lambda path, compression=compression:
+                            open_output(path, compression)))
+
+        print("Écriture d'une ligne par message ({:.1f} Mo) : débit, taille".format(megabytes))
+        for label, make in writers:
+            duration, written = measure(lambda path, make=make: write_lines(make(path), lines),
+                                        os.path.join(directory, label))
+            print("  {:7} {:7.1f} Mo/s  {:6.2f} Mo".format(
+                label, megabytes / duration, written / 1024 / 1024))
+
+        print()
+        print("SqlFile.insert : temps par ligne, selon max_allowed_packet")
+        for compression in available_compressions():
+            for packet in (0, 1048576):
+                path = os.path.join(directory, "insert.sql" + EXTENSIONS[compression])
+                duration, _ = measure(lambda path, compression=compression, packet=packet:
+                                      write_rows(SqlFile(path, "phpbb_", packet,
+                                                         compression=compression), posts),
+                                      path)
+                print("  {:7} {:8d} {:6.2f} µs".format(compression, packet,
+                                                      duration / count * 1e6))
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
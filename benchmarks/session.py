@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Lalf.
+#
+# Lalf is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Lalf is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Lalf.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Benchmark of the check of the login state made on each downloaded page
+(lalf.session.BaseSession.connected)
+
+The previous implementation, which parsed the whole page with PyQuery
+to look for a link of the main menu pointing to /login, is compared
+with the current one, which works on the source of the page, on a
+short page and on a topic page.
+
+Usage:
+    python3 -m benchmarks.session [repeat]
+"""
+
+import sys
+import timeit
+
+from pyquery import PyQuery
+
+from lalf.session import BaseSession
+
+SHORT_PAGE = ('<html><body><a class="mainmenu" href="/logout">Déconnexion</a>'
+              '<a class="mainmenu" href="/profile">Profil</a></body></html>')
+
+TOPIC_PAGE = ('<html><head><title>Sujet</title></head><body>'
+              '<a class="mainmenu" href="/logout">Déconnexion</a>'
+              '<a class="mainmenu" href="/profile">Profil</a><table>'
+              + "".join('<tr class="post"><td><span class="name"><a name="{0}"></a>'
+                        '<strong><a href="/u{0}">Membre</a></strong></span></td>'
+                        '<td><div class="postbody"><div>{1}</div></div></td></tr>'.format(
+                            index, "Lorem ipsum <b>dolor</b> sit amet " * 40)
+                        for index in range(15))
+              + '</table></body></html>')
+
+LOGGED_OUT_PAGE = SHORT_PAGE.replace('href="/logout"', 'href="/login"')
+
+INPUTS = [
+    ("courte", SHORT_PAGE),
+    ("sujet", TOPIC_PAGE),
+    ("déconnecté", LOGGED_OUT_PAGE),
+]
+
+class Session(BaseSession):
+    """
+    Session connected to the forum, without any configuration
+    """
+    def __init__(self): # pylint: disable=super-init-not-called
+        self.sid = "sid"
+
+def old_connected(session, html):
+    """
+    Previous implementation of BaseSession.connected
+    """
+    if session.sid:
+        if html:
+            document = PyQuery(html)
+            for element in document(".mainmenu"):
+                if element.get("href", "") == "/login":
+                    return False
+        return True
+    return False
+
+def measure(function, repeat):
+    """
+    Returns the best time of a call to function, in microseconds
+    """
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number * 1e6
+
+def main(repeat=9):
+    """
+    Print the time of a check with each implementation, for each page
+    """
+    session = Session()
+    print("Temps par page (µs, meilleur de {}) : PyQuery / actuelle".format(repeat))
+    for label, html in INPUTS:
+        if old_connected(session, html) != session.connected(html):
+            raise AssertionError("Résultats différents pour la page {}".format(label))
+
+        old = measure(lambda: old_connected(session, html), repeat)
+        new = measure(lambda: session.connected(html), repeat)
+        print("  {:11} {:6d} | {:8.2f}  {:8.2f}".format(label, len(html), old, new))
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -16,17 +16,26 @@
 # You should have received a copy of the GNU General Public License
 # along with Lalf.  If not, see <http://www.gnu.org/licenses/>.
 
+import argparse
+import asyncio
 import logging
 import sys
 
 from lalf.bb import load
-from lalf.sql import SqlFile
+from lalf.sql import open_dump
+from lalf.pipeline import DumpPipeline
 from lalf.config import read as read_config
 from lalf.ui import UI
 from lalf import session
 from lalf.__version__ import __version__
 
 def main():
+    parser = argparse.ArgumentParser(description="Exporte un forum Forumactif vers phpBB.")
+    parser.add_argument(
+        "--offline", action="store_true",
+        help="exporter le forum uniquement à partir du cache (voir l'option http_cache)")
+    args = parser.parse_args()
+
     logger = logging.getLogger("lalf")
     logger.setLevel(logging.DEBUG)
     logger.propagate = False
@@ -41,6 +50,8 @@ def main():
     logger.addHandler(filehandler)
 
     config = read_config("config.cfg")
+    if args.offline:
+        config["offline"] = True
     ui = UI()
 
     logger.info("Lalf %s", __version__)
@@ -54,14 +65,26 @@ def main():
     bb = load(config, ui)
     ui.bb = bb
 
+    if config["stream_dump"]:
+        bb.pipeline = DumpPipeline(bb, open_dump(config))
+
     try:
-        bb.export()
+        if bb.pipeline is not None:
+            bb.pipeline.start()
+
+        if config["use_asyncio"]:
+            asyncio.run(bb.export_async())
+        else:
+            bb.export()
 
         ui.update()
 
         for user in bb.users.values():
             user.confirm_email()
     except BaseException as e:
+        bb.session.close()
+        if bb.pipeline is not None:
+            bb.pipeline.cancel()
         bb.save()
         logger.exception(
             "Une erreur est survenue. Essayez de relancer le script. "
@@ -73,7 +96,14 @@ def main():
     bb.save()
 
     logging.info("Génération du fichier SQL")
-    with SqlFile("phpbb.sql", config["table_prefix"]) as sqlfile:
+    if bb.pipeline is not None:
+        # Only the rows which do not belong to a topic remain to be written
+        bb.pipeline.finish()
+        sqlfile = bb.pipeline.sqlfile
+    else:
+        sqlfile = open_dump(config)
+
+    with sqlfile:
         bb.dump(sqlfile)
 
     logging.info("L'exportation a été effectuée avec succés.")
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Lalf.
+#
+# Lalf is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Lalf is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Lalf.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Module handling the asynchronous connections to the forum (requires aiohttp)
+"""
+
+import asyncio
+import time
+
+import aiohttp
+
+from lalf.session import BaseSession, UnableToConnect, make_response
+
+class AsyncSession(BaseSession):
+    """
+    Object handling the connections to the forum with asyncio
+
+    It provides the same methods as lalf.session.Session as coroutines,
+    in order to download many pages concurrently in a single thread (see
+    Node.export_async). It should be used as an asynchronous context
+    manager.
+
+    Attrs:
+        window (int): The number of pages that can be downloaded
+            simultaneously
+    """
+    def __init__(self, config):
+        BaseSession.__init__(self, config)
+
+        self.session = None
+        self.lock = asyncio.Lock()
+
+        self.window = config["max_connections"]
+
+    async def __aenter__(self):
+        # The forum may be accessed through its ip address
+        self.session = aiohttp.ClientSession(
+            cookie_jar=aiohttp.CookieJar(unsafe=True),
+            timeout=aiohttp.ClientTimeout(sock_connect=self.config["connect_timeout"],
+                                          sock_read=self.config["read_timeout"]))
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.session.close()
+
+    async def send(self, url, **kwargs):
+        """
+        Download a file and return a requests.Response, respecting the
+        limits of the rate limiter
+        """
+        start = await self.limiter.acquire_async()
+        try:
+            async with self.session.get(url, **kwargs) as response:
+                content = await response.read()
+                response = make_response(str(response.url), response.status, response.headers,
+                                         content)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            # A network error is not a sign of throttling
+            self.limiter.release(start, cancelled=True)
+            raise
+        except asyncio.CancelledError:
+            # The request was hedged and the other one answered first
+            self.limiter.release(start, cancelled=True)
+            raise
+
+        throttled = self.throttled(url, response)
+        self.limiter.release(start, throttled, self.retry_after(response))
+        if not throttled:
+            self.record_latency(time.monotonic() - start)
+        return response
+
+    async def request(self, url, hedge=True, **kwargs):
+        """
+        Download a file. If the download takes longer than most of the
+        previous ones (see hedge_delay), the same request is sent again
+        and the first response received is returned.
+        """
+        delay = self.hedge_delay() if hedge else None
+        if delay is None:
+            return await self.send(url, **kwargs)
+
+        first = asyncio.ensure_future(self.send(url, **kwargs))
+        done, _ = await asyncio.wait([first], timeout=delay)
+        if done:
+            return first.result()
+
+        self.logger.debug("Téléchargement lent, envoi d'une seconde requête pour %s", url)
+        second = asyncio.ensure_future(self.send(url, **kwargs))
+        pending = {first, second}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    for other in pending:
+                        other.cancel()
+                    return future.result()
+
+        # Both requests failed
+        return first.result()
+
+    async def _get(self, path, hedge=True, **kwargs):
+        """
+        Download a file
+        """
+        return await self.request(self.url(path), hedge, **self.prepare(path, kwargs))
+
+    async def attempt(self, path, **kwargs):
+        """
+        Download a page of the forum, or return None if the connection
+        failed or timed out
+        """
+        try:
+            return await self._get(path, **kwargs)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self.logger.warning("Échec du téléchargement de %s : %r", path, e)
+            return None
+
+    async def connect(self):
+        """
+        Connect to the forum and initialize session, sid and tid.
+        """
+        self.logger.debug('Connection au forum')
+
+        # Reset session (the aiohttp session is kept since other
+        # downloads may be using it)
+        self.session.cookie_jar.clear()
+        self.sid = None
+        self.tid = None
+
+        self.connections += 1
+
+        # Log in (the request is not hedged, to get a single session id)
+        await self._get("/login", False, params=self.login_params())
+
+        # Check that the user is connected
+        self.set_sid((cookie.key, cookie.value) for cookie in self.session.cookie_jar)
+
+        if self.tid is None:
+            self.logger.debug('Récupération du tid')
+
+            response = await self._get('/admin/index.forum', False)
+            self.set_tid(response.url)
+
+    async def reconnect(self, connections):
+        """
+        Connect to the forum again, unless another download already did
+        it since the failed download started
+
+        Parameters :
+        connections -- value of the connections attribute when the
+                       download started
+        """
+        async with self.lock:
+            if self.connections == connections:
+                await self.connect()
+
+    async def get(self, path, **kwargs):
+        """
+        Download a page of the forum
+        """
+        key = self.cache_key(path, kwargs)
+        response = self.cached(key, path)
+        if response is not None:
+            return response
+
+        connections = self.connections
+        response = await self.attempt(path, **kwargs)
+
+        failures = 0
+        while (response is None or response.status_code >= 300
+               or not self.connected(response.text)):
+            if failures >= 4:
+                # The connection failed four times, there must be something wrong
+                raise UnableToConnect()
+            failures += 1
+
+            if failures >= 2:
+                # The connection failed two times, wait
+                delay = max(self.config["reconnect_delay"], self.limiter.backoff(failures - 1))
+                self.logger.info(
+                    "La connexion a échoué %d fois, attend %.1f secondes avant de réessayer.",
+                    failures, delay)
+                await asyncio.sleep(delay)
+
+            try:
+                await self.reconnect(connections)
+            except (UnableToConnect, aiohttp.ClientError, asyncio.TimeoutError):
+                connections = self.connections
+                continue
+            connections = self.connections
+            response = await self.attempt(path, **kwargs)
+
+        self.cache_response(key, response)
+        return response
+
+    async def get_admin(self, path, **kwargs):
+        """
+        Download a page of the forum's administration panel
+        """
+        if not self.tid and not self.config["offline"]:
+            await self.connect()
+
+        return await self.get(path, **self.admin_params(kwargs))
+
+    async def get_image(self, image, **kwargs):
+        """
+        Download an image
+        """
+        url = self.image_url(image)
+        key = self.cache_key(url, kwargs)
+        response = self.cached(key, url)
+        if response is None:
+            response = await self.request(url, **kwargs)
+            self.cache_response(key, response)
+
+        return response
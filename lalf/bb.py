@@ -19,13 +19,14 @@
 Module containing the BB class (the root of the forum)
 """
 
+import asyncio
 import logging
 import pickle
 import time
 
 from pyquery import PyQuery
 
-from lalf.node import Node
+from lalf.node import Node, EMPTY_SCOPE
 from lalf.forums import Forums
 from lalf.groups import Groups
 from lalf.users import Users
@@ -34,11 +35,15 @@ from lalf.smilies import Smilies
 from lalf import phpbb
 from lalf.session import Session
 from lalf.linkrewriter import LinkRewriter
+from lalf.statistics import Statistics
+from lalf.journal import Journal, SNAPSHOT_FILE
+from lalf.store import open_store
+from lalf.conversion import open_converter, TOPICS_INDEX, POSTS_INDEX
 from lalf.util import parse_date
 from lalf.ui import DummyUI
 from lalf.config import read as read_config
 
-@Node.expose("config", "session", "ui", "smilies", "users", "forums",
+@Node.expose("config", "session", "async_session", "ui", "smilies", "users", "forums",
              "announcements", self="root")
 class BB(Node):
     """
@@ -54,6 +59,32 @@ class BB(Node):
         current_users (int) : The number of users that have been exported
 
         dump_time (int): The time at the beginning of the dump
+        stats (Statistics): The statistics of the exported forum,
+            computed at the beginning of the dump
+        pipeline (DumpPipeline): The object writing the topics in the
+            dump file during the exportation (or None, see lalf.pipeline)
+        converter (Converter): The object converting the posts to
+            bbcode during the dump (see lalf.conversion)
+
+        topics_index (Dict(int, int)): The new id of the forum of each
+            topic
+        posts_index (Dict(int, int)): The id of the topic of each
+            exported post
+            The indexes are used to rewrite the links (see
+            lalf.linkrewriter). They are filled during the exportation
+            and rebuilt when the tree is loaded (see index).
+        index_log (list): The entries added to the indexes while the
+            posts are converted in other processes, as (index, key,
+            value) tuples where index is TOPICS_INDEX or POSTS_INDEX (or
+            None, see lalf.conversion.ConversionPool)
+
+        store (Store): The database containing the content of the posts
+            (or None, see lalf.store)
+        uses_store (bool): True if the content of the posts may have
+            been saved in the store
+        journal (Journal): The object saving the changes made to the tree
+        journal_generation (bytes): The id of the journal matching the
+            last snapshot of the tree (see lalf.journal)
     """
 
     # Attributes to save
@@ -61,13 +92,18 @@ class BB(Node):
                   "current_posts", "current_topics", "current_users",
                   "startdate", "record_online_date", "record_online_users",
                   "site_name", "site_desc", "smilies", "users",
-                  "forums", "announcements"]
+                  "forums", "announcements", "journal_generation", "uses_store"]
+
+    # Default values for the trees saved by older versions
+    journal_generation = None
+    uses_store = None
 
     def __init__(self, config, ui=None):
         Node.__init__(self)
 
         self.config = config
         self.session = Session(self.config)
+        self.async_session = None
         self.ui = ui
 
         # Statistics
@@ -87,13 +123,23 @@ class BB(Node):
         self.site_desc = ""
 
         self.dump_time = 0
+        self.stats = None
 
         self.smilies = {}
         self.users = {}
         self.forums = {}
         self.announcements = []
 
+        self.topics_index = {}
+        self.posts_index = {}
+        self.index_log = None
+
         self.linkrewriter = LinkRewriter(self)
+        self.store = open_store(self.config)
+        self.uses_store = self.store is not None
+        self.journal = Journal(self)
+        self.pipeline = None
+        self.converter = open_converter(self)
 
     def _export_(self):
         self.logger.info('Récupération des statistiques')
@@ -140,26 +186,33 @@ class BB(Node):
 
         self.add_child(Forums())
 
-    def _dump_(self, sqlfile):
-        self.logger.info("Création du fichier phpbb.sql")
-        self.dump_time = int(time.time())
-
-        # Clean tables
-        sqlfile.truncate("users")
-        sqlfile.truncate("user_group")
-        sqlfile.truncate("bots")
-
-        sqlfile.truncate("forums")
-        sqlfile.truncate("acl_groups")
-
-        sqlfile.truncate("topics")
-        sqlfile.truncate("topics_posted")
-
-        sqlfile.truncate("posts")
-        sqlfile.truncate("privmsgs")
-        sqlfile.truncate("privmsgs_to")
+    async def export_async(self):
+        """
+        Export the forum, downloading the pages of the forums and topics
+        concurrently with an asynchronous session (see Node.export_async)
+        """
+        # aiohttp is only required by this export mode
+        from lalf.asyncsession import AsyncSession
+
+        async with AsyncSession(self.config) as self.async_session:
+            # The pages downloaded by the _export_ methods (which are run
+            # in other threads) also go through the asynchronous session
+            self.session.forward(self.async_session, asyncio.get_running_loop())
+            try:
+                await Node.export_async(self)
+            finally:
+                self.session.forward(None, None)
+
+    def dump(self, sqlfile):
+        Node.dump(self, sqlfile)
+        # Write the posts which are still being converted
+        self.converter.close()
 
-        sqlfile.truncate("bbcodes")
+    def _dump_(self, sqlfile):
+        if self.pipeline is None:
+            self.logger.info("Création du fichier phpbb.sql")
+            self.truncate_tables(sqlfile)
+            self.stats = Statistics.compute(self)
 
         # Update configuration and statistics
         sqlfile.set_config("board_startdate", self.startdate)
@@ -169,12 +222,10 @@ class BB(Node):
         sqlfile.set_config("sitename", self.site_name)
         sqlfile.set_config("site_desc", self.site_desc)
 
-        num_posts = sum(1 for _ in self.get_posts())
-        num_topics = sum(1 for _ in self.get_topics())
         num_users = sum(1 for _ in self.users)
 
-        sqlfile.set_config("num_posts", num_posts)
-        sqlfile.set_config("num_topics", num_topics)
+        sqlfile.set_config("num_posts", self.stats.num_posts)
+        sqlfile.set_config("num_topics", self.stats.num_topics)
         sqlfile.set_config("num_users", num_users)
 
         newest_user_oldid = max(self.users)
@@ -188,18 +239,83 @@ class BB(Node):
         for bbcode in phpbb.BBCODES:
             sqlfile.insert("bbcodes", bbcode)
 
+    def truncate_tables(self, sqlfile):
+        """
+        Write the beginning of the dump file, which empties the tables
+        """
+        self.dump_time = int(time.time())
+
+        # Clean tables
+        sqlfile.truncate("users")
+        sqlfile.truncate("user_group")
+        sqlfile.truncate("bots")
+
+        sqlfile.truncate("forums")
+        sqlfile.truncate("acl_groups")
+
+        sqlfile.truncate("topics")
+        sqlfile.truncate("topics_posted")
+
+        sqlfile.truncate("posts")
+        sqlfile.truncate("privmsgs")
+        sqlfile.truncate("privmsgs_to")
+
+        sqlfile.truncate("bbcodes")
+
     def __setstate__(self, state):
         Node.__setstate__(self, state)
         self.linkrewriter = LinkRewriter(self)
-        # TODO : recompute current counts
+
+    def _checkpoint_(self, path):
+        self.journal.record(self, path)
 
     def save(self):
         """
-        Dump the tree representing the forum in a pickle file
+        Save the changes which are not in the journal yet (see lalf.journal)
         """
-        self.logger.info("Sauvegarde de l'état courant.")
-        with open("save.pickle", "wb") as fileobj:
-            pickle.dump(self, fileobj, 2)
+        if self.journal.dirty:
+            self.journal.compact()
+        else:
+            if self.store is not None:
+                self.store.commit()
+            self.journal.flush()
+
+    def recount(self):
+        """
+        Compute the numbers of exported users, topics and posts
+        """
+        self.current_users = len(self.users)
+        self.current_topics = sum(1 for topic in self.get_topics() if topic.exported)
+        self.current_posts = sum(1 for post in self.get_posts() if post.exported)
+
+    def index_topic(self, topic_id, forum_id):
+        """
+        Add a topic to topics_index
+        """
+        self.topics_index[topic_id] = forum_id
+        if self.index_log is not None:
+            self.index_log.append((TOPICS_INDEX, topic_id, forum_id))
+
+    def index_post(self, post_id, topic_id):
+        """
+        Add a post to posts_index
+        """
+        self.posts_index[post_id] = topic_id
+        if self.index_log is not None:
+            self.index_log.append((POSTS_INDEX, post_id, topic_id))
+
+    def index(self):
+        """
+        Build the indexes of the topics and posts (see topics_index and
+        posts_index)
+        """
+        self.topics_index = {}
+        self.posts_index = {}
+        for forum in self.forums.values():
+            for topic in forum.get_topics():
+                self.topics_index[topic.topic_id] = forum.newid
+                for post in topic.get_posts():
+                    self.posts_index[post.post_id] = topic.topic_id
 
     def get_topics(self):
         """
@@ -219,7 +335,8 @@ class BB(Node):
 
 def load(config=None, ui=None):
     """
-    Returns the BB node contained in the file save.pickle.
+    Returns the BB node contained in the file save.pickle, updated with
+    the records of the journal.
     """
     logger = logging.getLogger("lalf.bb.load")
 
@@ -230,11 +347,21 @@ def load(config=None, ui=None):
         config = read_config("config.cfg")
 
     try:
-        with open("save.pickle", "rb") as fileobj:
+        with open(SNAPSHOT_FILE, "rb") as fileobj:
             bb = pickle.load(fileobj)
+            bb.set_scope(EMPTY_SCOPE)
             bb.config = config
             bb.session = Session(config)
             bb.ui = ui
+            bb.store = open_store(config, bb.uses_store)
+            bb.uses_store = bb.store is not None
+            bb.journal = Journal(bb)
+            bb.pipeline = None
+            bb.index_log = None
+            bb.converter = open_converter(bb)
+            bb.journal.replay()
+            bb.recount()
+            bb.index()
     except FileNotFoundError:
         bb = BB(config, ui)
     except EOFError:
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Lalf.
+#
+# Lalf is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Lalf is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Lalf.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Module handling the writing of the dump as tab-separated files, which
+can be bulk loaded (with LOAD DATA in MySQL or COPY in PostgreSQL)
+"""
+
+import os
+
+from lalf.sql import open_output, escape as escape_mysql
+
+MYSQL_HEADER = """\
+-- Importation des fichiers de ce dossier dans une base de données MySQL.
+-- Depuis ce dossier :
+--     mysql --local-infile=1 -u <utilisateur> -p <base> < mysql.sql
+SET NAMES utf8mb4;
+"""
+
+POSTGRESQL_HEADER = """\
+-- Importation des fichiers de ce dossier dans une base de données PostgreSQL.
+-- Depuis ce dossier :
+--     psql -U <utilisateur> -d <base> -f postgresql.sql
+\\set ON_ERROR_STOP on
+SET client_encoding = 'UTF8';
+BEGIN;
+"""
+
+POSTGRESQL_FOOTER = """\
+COMMIT;
+"""
+
+def escape(string):
+    """
+    Escapes special characters in a string for use in a tab-separated file
+    (in the format expected by LOAD DATA and COPY)
+    """
+    # Most of the strings do not contain any special character
+    if "\\" in string or "\t" in string or "\n" in string or "\r" in string:
+        return (string.replace("\\", "\\\\").replace("\t", "\\t")
+                .replace("\n", "\\n").replace("\r", "\\r"))
+    return string
+
+def escape_postgresql(string):
+    """
+    Escapes special characters in a string for use in a PostgreSQL statement
+    """
+    return string.replace("'", "''")
+
+class BulkFile(object):
+    """
+    Object used to save the rows of the tables in tab-separated files,
+    instead of an sql dump (see SqlFile)
+
+    The rows of each table are written in <prefix><table>.tsv, or in
+    <prefix><table>.<n>.tsv if their columns differ from the ones of
+    the first row. The statements importing these files (and emptying
+    the tables, updating the configuration) are written in mysql.sql and
+    postgresql.sql, in the order in which they would be executed in the
+    sql dump.
+
+    Attrs:
+        path (str): The directory in which the files are written
+        prefix (str): A prefix that will be added before the table names
+
+    Example:
+        >>> with BulkFile("phpbb_tsv", "phpbb_"):
+        ...     sqlfile.truncate("posts")
+        ...     sqlfile.insert("posts", {
+        ...         "post_id": 1,
+        ...         "post_subject": "Subject",
+        ...         # ...
+        ...     })
+    """
+    def __init__(self, path, prefix=""):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.prefix = prefix
+
+        # Files of the rows, for each table and list of columns
+        self.files = {}
+
+        # Number of files of each table
+        self.counts = {}
+
+        # Statements of the import scripts, for MySQL and PostgreSQL
+        self.mysql = []
+        self.postgresql = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Close the files of the tables and write the import scripts
+        """
+        for fileobj in self.files.values():
+            fileobj.close()
+        self.files = {}
+
+        with open_output(os.path.join(self.path, "mysql.sql")) as fileobj:
+            fileobj.write(MYSQL_HEADER)
+            fileobj.writelines(self.mysql)
+
+        with open_output(os.path.join(self.path, "postgresql.sql")) as fileobj:
+            fileobj.write(POSTGRESQL_HEADER)
+            fileobj.writelines(self.postgresql)
+            fileobj.write(POSTGRESQL_FOOTER)
+
+    def open_table(self, table, columns):
+        """
+        Open the file containing the rows of a table with the given
+        columns, and add the statements importing it to the scripts
+        """
+        count = self.counts.get(table, 0) + 1
+        self.counts[table] = count
+
+        if count == 1:
+            filename = "{}{}.tsv".format(self.prefix, table)
+        else:
+            filename = "{}{}.{}.tsv".format(self.prefix, table, count)
+
+        self.mysql.append(
+            "LOAD DATA LOCAL INFILE '{filename}' INTO TABLE {prefix}{table} "
+            "CHARACTER SET utf8mb4 FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' "
+            "LINES TERMINATED BY '\\n' ({columns});\n".format(
+                filename=filename,
+                prefix=self.prefix,
+                table=table,
+                columns=", ".join(columns)))
+        self.postgresql.append("\\copy {prefix}{table} ({columns}) FROM '{filename}'\n".format(
+            filename=filename,
+            prefix=self.prefix,
+            table=table,
+            columns=", ".join(columns)))
+
+        fileobj = open_output(os.path.join(self.path, filename))
+        self.files[(table, columns)] = fileobj
+        return fileobj
+
+    def insert(self, table, entry):
+        """
+        Add a row to the file of a table
+
+        Attrs:
+            table (str):
+            entry (dict): Dictionnary associating column names to their values
+        """
+        columns = tuple(entry)
+        fileobj = self.files.get((table, columns))
+        if fileobj is None:
+            fileobj = self.open_table(table, columns)
+
+        values = []
+        for value in entry.values():
+            if value.__class__ is int:
+                # The integers (most of the columns) do not need to be escaped
+                values.append(str(value))
+            else:
+                values.append(escape(str(value)))
+
+        fileobj.write("\t".join(values) + "\n")
+
+    def truncate(self, table):
+        """
+        Add truncate statement to the import scripts
+        """
+        statement = "TRUNCATE TABLE {prefix}{table};\n".format(prefix=self.prefix, table=table)
+        self.mysql.append(statement)
+        self.postgresql.append(statement)
+
+    def set_config(self, name, value):
+        """
+        Update a value in the phpbb_config table
+        """
+        statement = "UPDATE {prefix}config SET config_value='{value}' WHERE config_name='{name}';\n"
+        self.mysql.append(statement.format(
+            prefix=self.prefix,
+            value=escape_mysql(str(value)),
+            name=escape_mysql(name)))
+        self.postgresql.append(statement.format(
+            prefix=self.prefix,
+            value=escape_postgresql(str(value)),
+            name=escape_postgresql(name)))
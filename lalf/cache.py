@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Lalf.
+#
+# Lalf is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Lalf is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Lalf.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Module handling the persistent cache of the downloaded pages
+"""
+
+import os
+import json
+import hashlib
+import tempfile
+import zlib
+
+# Parameters which change between sessions but not the content of the page
+IGNORED_PARAMS = ["tid"]
+
+class NotInCache(Exception):
+    """
+    Exception raised when a page is missing from the cache in offline mode
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path (str): The path of the page that could not be found
+        """
+        Exception.__init__(self)
+
+        self.path = path
+
+    def __str__(self):
+        return (
+            "La page {path} n'a pas été trouvée dans le cache. Relancez le script sans "
+            "l'option --offline pour la télécharger."
+        ).format(path=self.path)
+
+class Cache(object):
+    """
+    Persistent cache of the responses of the forum
+
+    Each request is identified by its path and its parameters (see
+    key). The bodies of the responses are compressed and stored in files
+    named after their hash, so that identical pages are only stored
+    once.
+
+    Attrs:
+        directory (str): The directory containing the cache
+    """
+    def __init__(self, directory="cache"):
+        self.directory = directory
+
+        for subdirectory in ("requests", "objects"):
+            path = os.path.join(self.directory, subdirectory)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+    @staticmethod
+    def key(path, params=None):
+        """
+        Returns the key identifying a request
+
+        Args:
+            path (str): The path (or url) of the page
+            params (Dict(str, str)): The GET parameters of the request
+        """
+        params = sorted((str(name), str(value)) for name, value in (params or {}).items()
+                        if name not in IGNORED_PARAMS)
+        return hashlib.sha1(json.dumps([path, params]).encode("utf-8")).hexdigest()
+
+    def _path(self, kind, name):
+        return os.path.join(self.directory, kind, name[:2], name)
+
+    def _write(self, path, data):
+        """
+        Atomically write data in a file
+        """
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname, exist_ok=True)
+
+        fd, tmppath = tempfile.mkstemp(dir=dirname)
+        with os.fdopen(fd, "wb") as fileobj:
+            fileobj.write(data)
+        os.replace(tmppath, path)
+
+    def get(self, key):
+        """
+        Returns the response stored for key, or None if it is not in the cache
+
+        Returns:
+            (Dict): Dictionnary containing the url, status_code, headers and
+                content of the response
+        """
+        try:
+            with open(self._path("requests", key), "rb") as fileobj:
+                entry = json.loads(fileobj.read().decode("utf-8"))
+            with open(self._path("objects", entry["content"]), "rb") as fileobj:
+                entry["content"] = zlib.decompress(fileobj.read())
+        except (OSError, ValueError, zlib.error):
+            return None
+
+        return entry
+
+    def set(self, key, response):
+        """
+        Store a response (a requests.Response) in the cache
+        """
+        content = response.content
+        digest = hashlib.sha1(content).hexdigest()
+
+        path = self._path("objects", digest)
+        if not os.path.isfile(path):
+            self._write(path, zlib.compress(content))
+
+        entry = {
+            "url": response.url,
+            "status_code": response.status_code,
+            "headers": {"Content-Type": response.headers.get("Content-Type", "")},
+            "content": digest
+        }
+        self._write(self._path("requests", key), json.dumps(entry).encode("utf-8"))
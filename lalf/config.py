@@ -24,8 +24,43 @@ import os.path
 
 # Options defined in the config file
 STRINGS = ["url", "admin_name", "admin_password", "table_prefix", "gocr", "temporary_theme",
-           "phpbb_url", "default_lang"]
-BOOLEANS = ["use_ocr", "export_smilies", "rewrite_links"]
+           "phpbb_url", "default_lang", "dump_format", "dump_compression"]
+BOOLEANS = ["use_ocr", "export_smilies", "rewrite_links", "use_asyncio", "http_cache",
+            "offline", "use_sqlite", "stream_dump", "fast_import"]
+INTEGERS = ["max_connections", "checkpoint_interval", "dump_processes",
+            "conversion_cache_size", "max_allowed_packet", "shard_size"]
+FLOATS = ["requests_per_second", "backoff_base", "backoff_max", "latency_threshold",
+          "connect_timeout", "read_timeout", "hedge_percentile", "reconnect_delay"]
+
+# Values of the dump_format and dump_compression options
+DUMP_FORMATS = ["sql", "tsv"]
+DUMP_COMPRESSIONS = ["none", "gzip", "zstd"]
+
+# Default values of the options that may be missing from older configuration files
+DEFAULTS = {
+    "max_connections": "1",
+    "use_asyncio": "false",
+    "http_cache": "false",
+    "offline": "false",
+    "requests_per_second": "0",
+    "backoff_base": "2",
+    "backoff_max": "60",
+    "reconnect_delay": "30",
+    "latency_threshold": "10",
+    "connect_timeout": "10",
+    "read_timeout": "60",
+    "hedge_percentile": "95",
+    "checkpoint_interval": "300",
+    "use_sqlite": "false",
+    "stream_dump": "false",
+    "dump_processes": "1",
+    "conversion_cache_size": "1000",
+    "max_allowed_packet": "1048576",
+    "dump_format": "sql",
+    "fast_import": "false",
+    "shard_size": "0",
+    "dump_compression": "none"
+}
 
 class NoConfigurationFile(Exception):
     """
@@ -82,6 +117,7 @@ def read(filename):
         raise NoConfigurationFile(filename)
 
     cfg = configparser.ConfigParser()
+    cfg.read_dict({"Configuration": DEFAULTS})
     with open(filename, "r") as fileobj:
         cfg.read_file(fileobj)
 
@@ -93,7 +129,21 @@ def read(filename):
 
         for option in BOOLEANS:
             config[option] = cfg.getboolean("Configuration", option)
-    except (configparser.NoSectionError, configparser.NoOptionError) as e:
+
+        for option in INTEGERS:
+            config[option] = cfg.getint("Configuration", option)
+
+        for option in FLOATS:
+            config[option] = cfg.getfloat("Configuration", option)
+    except (configparser.NoSectionError, configparser.NoOptionError, ValueError) as e:
         raise InvalidConfigurationFile(filename, e)
 
+    if config["dump_format"] not in DUMP_FORMATS:
+        raise InvalidConfigurationFile(filename, ValueError(
+            "dump_format doit valoir {}".format(" ou ".join(DUMP_FORMATS))))
+
+    if config["dump_compression"] not in DUMP_COMPRESSIONS:
+        raise InvalidConfigurationFile(filename, ValueError(
+            "dump_compression doit valoir {}".format(" ou ".join(DUMP_COMPRESSIONS))))
+
     return config
@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Lalf.
+#
+# Lalf is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Lalf is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Lalf.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Module handling the conversion of the posts to bbcode during the dump,
+possibly in several processes
+"""
+
+import collections
+import logging
+import multiprocessing
+import os
+import random
+
+from lalf.linkrewriter import LinkRewriter
+from lalf import htmltobbcode
+
+# Number of posts sent to a process at once
+BATCH_SIZE = 64
+
+# Number of batches sent to each process before the results of the
+# first one are written
+BATCHES_PER_PROCESS = 4
+
+# Indexes of the entries of BB.index_log
+TOPICS_INDEX = 0
+POSTS_INDEX = 1
+
+class Reference(object):
+    """
+    Copy of the id of a user or a forum in the new forum (see Context)
+
+    Attrs:
+        newid (int): The id in the new forum
+    """
+    __slots__ = ["newid"]
+
+    def __init__(self, newid):
+        self.newid = newid
+
+class Context(object):
+    """
+    Copy of the data of the forum needed by htmltobbcode.Parser (the
+    configuration, the smilies and the ids used to rewrite the links),
+    which can be sent to other processes instead of the whole tree
+
+    Attrs:
+        config (dict): The configuration
+        smilies (Dict(int, dict)): The smilies
+        forums (Dict(str, Reference)): The new ids of the forums
+        users (Dict(int, Reference)): The new ids of the users
+        topics_index (Dict(int, int)): See BB.topics_index
+        posts_index (Dict(int, int)): See BB.posts_index
+        linkrewriter (LinkRewriter): The object used to rewrite the links
+    """
+    def __init__(self, bb):
+        self.config = bb.config
+        self.smilies = dict(bb.smilies)
+        self.forums = {oldid: Reference(forum.newid) for oldid, forum in bb.forums.items()}
+        self.users = {oldid: Reference(user.newid) for oldid, user in bb.users.items()}
+        # The indexes, which may be large, are only used to rewrite the
+        # links (they are not copied, since the context is sent to the
+        # processes when they are started, the entries added later are
+        # sent with the batches)
+        if bb.config["rewrite_links"]:
+            self.topics_index = bb.topics_index
+            self.posts_index = bb.posts_index
+        else:
+            self.topics_index = {}
+            self.posts_index = {}
+        self.linkrewriter = LinkRewriter(self)
+
+    def __getstate__(self):
+        # The link rewriter is recreated by __setstate__
+        odict = self.__dict__.copy()
+        del odict["linkrewriter"]
+        return odict
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.linkrewriter = LinkRewriter(self)
+
+class Converter(object):
+    """
+    Object converting the posts to bbcode in the current process
+
+    Attrs:
+        bb (BB): The root of the tree
+        cache (ConversionCache): The conversions of the last fragments
+            (see htmltobbcode.ConversionCache), which can also be used
+            directly for the fragments which are needed immediately
+    """
+    def __init__(self, bb):
+        self.logger = logging.getLogger("{}.{}".format(self.__class__.__module__,
+                                                       self.__class__.__name__))
+        self.bb = bb
+        self.cache = htmltobbcode.ConversionCache(bb.config["conversion_cache_size"])
+
+    def convert(self, html, callback):
+        """
+        Convert the content of a post to bbcode and give the result to
+        callback (a function taking a BBCodePost)
+        """
+        callback(self.cache.convert(self.bb, html))
+
+    def close(self):
+        """
+        Make sure that all the callbacks have been called
+        """
+        self.log_cache()
+
+    def log_cache(self):
+        """
+        Write the number of fragments found in the cache in the log
+        """
+        total = self.cache.hits + self.cache.misses
+        if total > 0:
+            self.logger.debug("Cache des conversions : %d fragments sur %d (%.1f %%)",
+                              self.cache.hits, total, 100 * self.cache.hits / total)
+
+# State of the processes of the pool (see ConversionPool)
+_context = None
+_cache = None
+_records = []
+# Number of entries of the index log added to the context
+_version = 0
+
+class _RecordHandler(logging.Handler):
+    """
+    Handler saving the log records of a process of the pool, so that
+    they can be written by the main process
+    """
+    def emit(self, record):
+        # Format the arguments, which may not be picklable
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        _records.append(record)
+
+def _init_process(context, level):
+    global _context, _cache # pylint: disable=global-statement
+    _context = context
+    _cache = htmltobbcode.ConversionCache(context.config["conversion_cache_size"])
+
+    # The processes would otherwise generate the same uids
+    random.seed()
+
+    logger = logging.getLogger("lalf")
+    logger.setLevel(level)
+    logger.propagate = False
+    logger.addHandler(_RecordHandler())
+
+def _convert_batch(texts, start, entries):
+    global _version # pylint: disable=global-statement
+    # Add the entries of the index log which are not in the context yet
+    if _version < start:
+        raise RuntimeError("Entrées des index manquantes dans le processus {}".format(os.getpid()))
+    indexes = (_context.topics_index, _context.posts_index)
+    for index, key, value in entries[_version - start:]:
+        indexes[index][key] = value
+    _version = max(_version, start + len(entries))
+
+    del _records[:]
+    hits, misses = _cache.hits, _cache.misses
+    posts = [_cache.convert(_context, html) for html in texts]
+    return (posts, list(_records), (_cache.hits - hits, _cache.misses - misses),
+            (os.getpid(), _version))
+
+class ConversionPool(Converter):
+    """
+    Object converting the posts to bbcode in a pool of processes
+
+    The posts are sent by batches to the processes. The callbacks are
+    called in the order in which the posts were given to convert, once
+    BATCHES_PER_PROCESS batches are waiting for each process (or when
+    close is called), so the dump does not depend on the speed of the
+    processes.
+
+    Each process has its own cache. Their numbers of hits and misses are
+    added to the ones of the cache of the main process.
+
+    With the stream_dump option, topics and posts are added to the
+    indexes while the posts are converted. They are recorded in
+    BB.index_log once the pool is started, and each batch contains the
+    entries of the log which may be unknown to the process receiving it,
+    so the links are rewritten like in the main process.
+
+    Attrs:
+        processes (int): The number of processes
+        pool (multiprocessing.Pool): The pool, started when the first
+            batch is sent
+        log_start (int): The position of the first entry of
+            BB.index_log (the previous ones are known by all the
+            processes and have been removed)
+        versions (Dict(int, int)): The number of entries of the log
+            known by each process (by pid)
+    """
+    def __init__(self, bb, processes):
+        Converter.__init__(self, bb)
+        self.processes = processes
+        self.pool = None
+        self.log_start = 0
+        self.versions = {}
+
+        self.batch = []
+        self.pending = collections.deque()
+
+    def convert(self, html, callback):
+        self.batch.append((html, callback))
+        if len(self.batch) >= BATCH_SIZE:
+            self.submit()
+
+    def submit(self):
+        """
+        Send the current batch to the pool
+        """
+        if not self.batch:
+            return
+
+        if self.pool is None:
+            # The context is created once all the users, forums and
+            # smilies have been exported. The processes are spawned
+            # since other threads may be running.
+            self.logger.info("Conversion des messages avec %d processus", self.processes)
+            # The log is started before the context is copied: the
+            # entries added in between are in both
+            if self.bb.config["rewrite_links"]:
+                self.bb.index_log = []
+            self.pool = multiprocessing.get_context("spawn").Pool(
+                self.processes, _init_process,
+                (Context(self.bb), logging.getLogger("lalf").getEffectiveLevel()))
+
+        entries = []
+        log = self.bb.index_log
+        if log is not None:
+            # Remove the entries known by all the processes
+            if len(self.versions) >= self.processes:
+                known = min(self.versions.values())
+                del log[:known - self.log_start]
+                self.log_start = known
+            entries = log[:]
+
+        texts = [html for html, _ in self.batch]
+        callbacks = [callback for _, callback in self.batch]
+        self.pending.append((self.pool.apply_async(_convert_batch,
+                                                   (texts, self.log_start, entries)),
+                             callbacks))
+        self.batch = []
+
+        while len(self.pending) > self.processes * BATCHES_PER_PROCESS:
+            self.write_oldest()
+
+    def write_oldest(self):
+        """
+        Wait for the oldest batch and give the results to the callbacks
+        """
+        result, callbacks = self.pending.popleft()
+        posts, records, (hits, misses), (pid, version) = result.get()
+        self.versions[pid] = version
+        self.cache.hits += hits
+        self.cache.misses += misses
+
+        for record in records:
+            logging.getLogger(record.name).handle(record)
+
+        for callback, post in zip(callbacks, posts):
+            callback(post)
+
+    def close(self):
+        self.submit()
+        while self.pending:
+            self.write_oldest()
+
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+            self.bb.index_log = None
+            self.log_start = 0
+            self.versions = {}
+
+        self.log_cache()
+
+def open_converter(bb):
+    """
+    Returns the object converting the posts to bbcode, according to the
+    dump_processes option
+    """
+    processes = bb.config["dump_processes"]
+    if processes == 0:
+        try:
+            processes = len(os.sched_getaffinity(0))
+        except AttributeError:
+            processes = os.cpu_count() or 1
+
+    if processes > 1:
+        return ConversionPool(bb, processes)
+    return Converter(bb)
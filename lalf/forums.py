@@ -23,11 +23,10 @@ import re
 
 from pyquery import PyQuery
 
-from lalf.node import Node
+from lalf.node import Node, JOURNAL
 from lalf.topics import ForumPage
 from lalf.posts import NoPost
 from lalf.util import pages, clean_url
-from lalf import htmltobbcode
 
 def default_forum_acl(forumid):
     for gid, perm in ((1, 17), # guests: readonly
@@ -68,6 +67,11 @@ class Forum(Node):
     STATE_KEEP = ["oldid", "newid", "parent", "title", "description", "icon", "left_id",
                   "right_id", "status", "num_topics", "num_posts", "forum_type"]
 
+    CHECKPOINT = JOURNAL
+
+    # Default value for the nodes saved by older versions
+    subforums = []
+
     def __init__(self, oldid, newid, left_id, parent, title):
         Node.__init__(self)
         self.oldid = oldid
@@ -88,16 +92,40 @@ class Forum(Node):
         self.num_topics = None
         self.num_posts = None
 
+        # Forums whose informations were found on the page of this forum
+        self.subforums = []
+
     def _export_(self):
         self.logger.info('Récupération du forum %s', self.oldid)
 
-        response = self.session.get("/{}-a".format(self.oldid))
+        response = self.session.get(self._path_())
 
         # Get subforums descriptions, number of topics, ...
-        self.forums_node.get_subforums_infos(response.text)
+        self.subforums = self.forums_node.get_subforums_infos(response.text)
 
         for page in pages(response.text):
-            self.add_child(ForumPage(page))
+            if page == 0:
+                # The first page has just been downloaded
+                self.add_child(ForumPage(page, response.text))
+            else:
+                self.add_child(ForumPage(page))
+
+    def _path_(self):
+        return "/{}-a".format(self.oldid)
+
+    def _journal_(self):
+        # Informations about the subforums (see Forums.get_subforums_infos)
+        return {oldid: (self.forums[oldid].status, self.forums[oldid].description,
+                        self.forums[oldid].num_topics, self.forums[oldid].num_posts)
+                for oldid in self.subforums}
+
+    def _replay_(self, data):
+        for oldid, (status, description, num_topics, num_posts) in data.items():
+            forum = self.forums[oldid]
+            forum.status = status
+            forum.description = description
+            forum.num_topics = num_topics
+            forum.num_posts = num_posts
 
     def get_topics(self):
         """
@@ -134,17 +162,12 @@ class Forum(Node):
 
         parents = "a:{}:{{{}}}".format(len(entries), "".join(reversed(entries)))
 
-        parser = htmltobbcode.Parser(self.root)
-        parser.feed(self.description)
-        description = parser.get_post()
+        description = self.root.converter.cache.convert(self.root, self.description)
 
-        num_posts = sum(1 for post in self.get_posts())
-        num_topics = sum(1 for post in self.get_topics())
-
-        if num_posts == 0:
-            last_post = NoPost()
-        else:
-            last_post = max(self.get_posts(), key=lambda post: post.time)
+        stats = self.root.stats.forum(self)
+        num_posts = stats.num_posts
+        num_topics = stats.num_topics
+        last_post = stats.last_post or NoPost()
 
         sqlfile.insert("forums", {
             "forum_id" : self.newid,
@@ -241,11 +264,16 @@ class Forums(Node):
         """
         Get informations (description, number of topics and posts, ...) about
         the forums listed on a page
+
+        Returns:
+            (List(str)): The ids of the forums listed on the page
         """
         document = PyQuery(html)
 
         idpattern = re.compile(r"/([fc]\d+)-.*")
 
+        subforums = []
+
         for element in document("a.forumlink"):
             e = PyQuery(element)
 
@@ -269,3 +297,7 @@ class Forums(Node):
             # Get subforum numbers of topics and posts
             self.forums[oldid].num_topics = int(row("td").eq(2).text())
             self.forums[oldid].num_posts = int(row("td").eq(3).text())
+
+            subforums.append(oldid)
+
+        return subforums
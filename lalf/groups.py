@@ -166,3 +166,9 @@ class Groups(Node):
                     break
 
                 self.add_child(Group(oldid, name, description, leader_name, colour, group_type))
+
+    def _finish_(self):
+        # The colours of the users are needed by the topics, which may
+        # be dumped before the users (see lalf.pipeline)
+        for user in self.users.values():
+            user.update_colour()
@@ -24,9 +24,11 @@ import re
 from html.parser import HTMLParser
 import base64
 from urllib.parse import urlparse, urlunparse
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 from io import StringIO
 
+from lxml import etree, html as lxml_html
+
 from lalf.phpbb import BBCODES
 from lalf.util import random_string
 
@@ -52,23 +54,22 @@ TAGS = {
 for bbcode in BBCODES:
     TAGS[bbcode["bbcode_tag"]] = bbcode["bbcode_id"]
 
+# Index and mask of the bit of each tag in the bitfield of a post
+BITS = {tag: (bbcode_id // 8, 1 << (7 - bbcode_id % 8))
+        for tag, bbcode_id in TAGS.items() if bbcode_id >= 0}
+
 def escape(string):
     """
     Transform some characters in valid bbcodes
 
     Phpbb uses the same function (bbcode_specialchars in includes/message_parser.php)
     """
-    replace = {
-        '<': '&lt;',
-        '>': '&gt;',
-        '[': '&#91;',
-        ']': '&#93;',
-        '.': '&#46;',
-        ':': '&#58;'
-    }
-    for key, value in replace.items():
-        string = string.replace(key, value)
-    return string
+    # The replacements do not add any of the replaced characters, so
+    # their order does not matter. Chained calls to str.replace are
+    # faster than str.translate, which handles the characters one by one
+    # when they are replaced by several characters.
+    return (string.replace("<", "&lt;").replace(">", "&gt;").replace("[", "&#91;")
+            .replace("]", "&#93;").replace(".", "&#46;").replace(":", "&#58;"))
 
 def process_link(bb, url):
     """
@@ -131,23 +132,75 @@ class Node(object):
         child.parent = self
         self.children.append(child)
 
-    def get_bbcode(self, fileobj, bb, uid=""):
+    def get_bbcode(self, fileobj, bb, uid="", bitfield=None):
         """
-        Write the bbcode corresponding to this node in a file object
+        Write the bbcode corresponding to this node and its descendants in
+        a file object, and add their tags to the bitfield if it is given
+
+        The tree is walked once, with a stack instead of recursive calls,
+        so the depth of the tree is not limited. The bitfield contains the
+        tags of all the descendants, even those which are not rendered
+        (see get_bbcode_start), as they are after the rendering.
+
+        Args:
+            bitfield (Optionnal(List(int))): The bitfield of the post, as
+                a list of 10 bytes
         """
-        for child in self.children:
-            child.get_bbcode(fileobj, bb, uid)
+        end = self.get_bbcode_start(fileobj, bb, uid)
+        if end is None:
+            if bitfield is not None:
+                self.get_bitfield(bitfield)
+            return
+        if bitfield is not None and self.tag in BITS:
+            index, mask = BITS[self.tag]
+            bitfield[index] |= mask
+
+        # Stack of the nodes being rendered: the bbcode written after their
+        # children, and an iterator on the children not rendered yet
+        stack = [(end, iter(self.children))]
+        while stack:
+            end, children = stack[-1]
+            for node in children:
+                if node.__class__ is TextNode:
+                    # Most of the nodes
+                    fileobj.write(node.text)
+                    continue
+
+                node_end = node.get_bbcode_start(fileobj, bb, uid)
+                if node_end is not None:
+                    if bitfield is not None and node.tag in BITS:
+                        index, mask = BITS[node.tag]
+                        bitfield[index] |= mask
+                    stack.append((node_end, iter(node.children)))
+                    break
+                elif bitfield is not None and (node.children or node.tag in BITS):
+                    node.get_bitfield(bitfield)
+            else:
+                stack.pop()
+                fileobj.write(end)
 
-    def get_bitfield(self, bitfield):
+    def get_bbcode_start(self, fileobj, bb, uid=""):
         """
-        Get the bitifield of this node
+        Write the beginning of the bbcode corresponding to this node, which
+        is followed by the bbcode of its children
+
+        Returns:
+            str: The end of the bbcode of the node, written after the
+                children, or None if the children must not be rendered
         """
-        if self.tag in TAGS and TAGS[self.tag] >= 0:
-            c, d = divmod(TAGS[self.tag], 8)
-            bitfield[c] |= (1 << (7-d))
+        return ""
 
-        for child in self.children:
-            child.get_bitfield(bitfield)
+    def get_bitfield(self, bitfield):
+        """
+        Add the tags of this node and of its descendants to the bitfield
+        """
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if node.tag in BITS:
+                index, mask = BITS[node.tag]
+                bitfield[index] |= mask
+            stack.extend(node.children)
 
 class TextNode(Node):
     """
@@ -157,8 +210,29 @@ class TextNode(Node):
         Node.__init__(self)
         self.text = text
 
-    def get_bbcode(self, fileobj, bb, uid=""):
+    def get_bbcode_start(self, fileobj, bb, uid=""):
         fileobj.write(self.text)
+        return None
+
+# Parsers used for the fragments saved by PyQuery.html (see
+# parse_fragment), without the default limit on the depth of the tree
+XML_PARSER = etree.XMLParser(resolve_entities=False, huge_tree=True)
+HTML_PARSER = lxml_html.HTMLParser(huge_tree=True)
+
+def parse_fragment(html):
+    """
+    Returns an lxml element containing an html fragment
+
+    The fragments saved during the exportation (the content of the
+    posts, the descriptions of the forums, ...) are the xml
+    serialization of the pages parsed by PyQuery, so they are parsed
+    back with an xml parser, which gives the same elements. The html
+    parser of lxml is used if the fragment is not well-formed.
+    """
+    try:
+        return etree.fromstring("<div>" + html + "</div>", XML_PARSER)
+    except etree.XMLSyntaxError:
+        return lxml_html.fragment_fromstring(html, create_parent="div", parser=HTML_PARSER)
 
 BBCodePost = namedtuple("BBCodePost", ("text", "uid", "bitfield"))
 
@@ -223,20 +297,59 @@ class Parser(HTMLParser):
         if uid != "":
             uid = ":"+uid
 
-        # Get the post's text
+        # Get the post's text and bitfield
         fileobj = StringIO()
-        self.root_node.get_bbcode(fileobj, self.bb, uid)
+        bitfield = [0] * 10
+        self.root_node.get_bbcode(fileobj, self.bb, uid, bitfield)
         text = fileobj.getvalue().rstrip("\n")
         fileobj.close()
 
-        # Get the bitfield
-        bitfield = [0] * 10
-        self.root_node.get_bitfield(bitfield)
         bitfield = ''.join([chr(c) for c in bitfield]).rstrip('\0').encode("latin-1")
         bitfield = base64.b64encode(bitfield).decode("utf-8")
 
         return BBCodePost(text, actual_uid, bitfield)
 
+    def feed_tree(self, element):
+        """
+        Handle the content of an lxml element (its text and its
+        descendants, but not the element itself nor its tail), like feed
+        does with html source, without serializing it
+
+        The elements of a document parsed by PyQuery can be given
+        directly. Unlike with feed, the void elements (<br>, <img>, ...)
+        are closed even when their tag does not end with "/>".
+        """
+        if element.text:
+            self.handle_data(element.text)
+
+        # Stack of the open elements, with an iterator on their children
+        stack = [(element, iter(element))]
+        while stack:
+            parent, children = stack[-1]
+            for child in children:
+                if isinstance(child.tag, str):
+                    self.handle_starttag(child.tag, child.items())
+                    if child.text:
+                        self.handle_data(child.text)
+                    stack.append((child, iter(child)))
+                    break
+                # The comments and processing instructions are ignored,
+                # but not the text following them
+                elif child.tail:
+                    self.handle_data(child.tail)
+            else:
+                stack.pop()
+                if stack:
+                    self.handle_endtag(parent.tag)
+                    if parent.tail:
+                        self.handle_data(parent.tail)
+
+    def feed_fragment(self, html):
+        """
+        Handle an html fragment (see parse_fragment) with feed_tree
+        """
+        self.feed_tree(parse_fragment(html))
+
     def handle_data(self, data):
         """
         Handle the text nodes
@@ -293,8 +406,8 @@ class CaptureNode(Node):
     def add_text(self, text):
         self.text += text
 
-    def get_bbcode(self, fileobj, bb, uid=""):
-        return
+    def get_bbcode_start(self, fileobj, bb, uid=""):
+        return None
 
 class SmileyNode(Node):
     """
@@ -304,11 +417,11 @@ class SmileyNode(Node):
         Node.__init__(self)
         self.smiley_id = smiley_id
 
-    def get_bbcode(self, fileobj, bb, uid=""):
+    def get_bbcode_start(self, fileobj, bb, uid=""):
         try:
             smiley = bb.smilies[self.smiley_id]
         except KeyError:
-            return
+            return None
 
         if smiley["smiley_url"]:
             fileobj.write((
@@ -321,6 +434,7 @@ class SmileyNode(Node):
                 title=smiley["emotion"]))
         else:
             fileobj.write(" {code} ".format(**bb.smilies[self.smiley_id]))
+        return None
 
 class InlineTagNode(Node):
     """
@@ -334,27 +448,24 @@ class InlineTagNode(Node):
         if content:
             self.add_text(content)
 
-    def get_bbcode(self, fileobj, bb, uid=""):
+    def get_bbcode_start(self, fileobj, bb, uid=""):
         if self.tag not in TAGS:
             logger = logging.getLogger("lalf.htmltobbcode")
             logger.warning("La balise bbcode [%s] n'est pas supportée.", self.tag)
+            return ""
 
-            Node.get_bbcode(self, fileobj, bb, uid)
+        fileobj.write("[{}{}{}]".format(self.tag, self.attrs, uid))
+        if self.closing_tag:
+            return "[/{}{}]".format(self.closing_tag, uid)
         else:
-            fileobj.write("[{}{}{}]".format(self.tag, self.attrs, uid))
-            Node.get_bbcode(self, fileobj, bb, uid)
-            if self.closing_tag:
-                fileobj.write("[/{}{}]".format(self.closing_tag, uid))
-            else:
-                fileobj.write("[/{}{}]".format(self.tag.rstrip("="), uid))
+            return "[/{}{}]".format(self.tag.rstrip("="), uid)
 
 class BlockTagNode(InlineTagNode):
     """
     A node representing an block element
     """
-    def get_bbcode(self, fileobj, bb, uid=""):
-        InlineTagNode.get_bbcode(self, fileobj, bb, uid)
-        fileobj.write("\n")
+    def get_bbcode_start(self, fileobj, bb, uid=""):
+        return InlineTagNode.get_bbcode_start(self, fileobj, bb, uid) + "\n"
 
 class CodeQuoteNode(BlockTagNode):
     """
@@ -363,7 +474,7 @@ class CodeQuoteNode(BlockTagNode):
     def __init__(self):
         BlockTagNode.__init__(self, "quote")
 
-    def get_bbcode(self, fileobj, bb, uid=""):
+    def get_bbcode_start(self, fileobj, bb, uid=""):
         try:
             node = self.children[0]
         except IndexError:
@@ -385,7 +496,7 @@ class CodeQuoteNode(BlockTagNode):
                 except AttributeError:
                     pass
 
-        BlockTagNode.get_bbcode(self, fileobj, bb, uid)
+        return BlockTagNode.get_bbcode_start(self, fileobj, bb, uid)
 
 class ItemNode(InlineTagNode):
     """
@@ -394,7 +505,7 @@ class ItemNode(InlineTagNode):
     def __init__(self):
         InlineTagNode.__init__(self, "*", closing_tag="*:m")
 
-    def get_bbcode(self, fileobj, bb, uid=""):
+    def get_bbcode_start(self, fileobj, bb, uid=""):
         try:
             node = self.children[-1]
         except IndexError:
@@ -409,8 +520,7 @@ class ItemNode(InlineTagNode):
         else:
             newlines = ""
 
-        InlineTagNode.get_bbcode(self, fileobj, bb, uid)
-        fileobj.write(newlines)
+        return InlineTagNode.get_bbcode_start(self, fileobj, bb, uid) + newlines
 
 class EmailNode(InlineTagNode):
     """
@@ -420,7 +530,7 @@ class EmailNode(InlineTagNode):
         InlineTagNode.__init__(self, "email")
         self.email = email
 
-    def get_bbcode(self, fileobj, bb, uid=""):
+    def get_bbcode_start(self, fileobj, bb, uid=""):
         try:
             text = self.children[0].text
         except (IndexError, AttributeError):
@@ -435,7 +545,7 @@ class EmailNode(InlineTagNode):
         else:
             self.tag = "email="
             self.attrs = escape(self.email)
-        InlineTagNode.get_bbcode(self, fileobj, bb, uid)
+        return InlineTagNode.get_bbcode_start(self, fileobj, bb, uid)
 
 class UrlNode(InlineTagNode):
     """
@@ -446,7 +556,7 @@ class UrlNode(InlineTagNode):
         self.url = url
         self.postlink = postlink
 
-    def get_bbcode(self, fileobj, bb, uid=""):
+    def get_bbcode_start(self, fileobj, bb, uid=""):
         try:
             text = self.children[0].text
         except (IndexError, AttributeError):
@@ -465,7 +575,7 @@ class UrlNode(InlineTagNode):
             else:
                 self.tag = "url="
                 self.attrs = escape(url)
-            InlineTagNode.get_bbcode(self, fileobj, bb, uid)
+            return InlineTagNode.get_bbcode_start(self, fileobj, bb, uid)
         else:
             # Magic url
             local = url.startswith(bb.config["phpbb_url"])
@@ -485,6 +595,7 @@ class UrlNode(InlineTagNode):
             else:
                 fileobj.write('<!-- m --><a class="postlink" href="{}">{}</a><!-- m -->'
                               .format(url, ellipsized_url))
+            return None
 
 @Parser.handler("i", "u", "strike", "sub", "sup", "hr", "tr")
 def _inline_handler(tag, attrs):
@@ -596,3 +707,71 @@ def _marquee_handler(tag, attrs):
         return InlineTagNode("updown")
     else:
         return InlineTagNode("scroll")
+
+# Uid of the posts saved in the cache, replaced by a random one when they
+# are returned (the xml and html parsers never produce a null character)
+SENTINEL_UID = "\0" * 8
+
+# Options which change the conversion of a fragment (see ConversionCache)
+CACHE_OPTIONS = ("url", "phpbb_url", "rewrite_links")
+
+def convert(bb, html, uid=None):
+    """
+    Returns an html fragment converted to bbcode (see Parser.feed_fragment
+    and Parser.get_post)
+    """
+    parser = Parser(bb)
+    parser.feed_fragment(html)
+    return parser.get_post(uid)
+
+class ConversionCache(object):
+    """
+    Bounded LRU cache of the conversions of html fragments, so that the
+    fragments which are repeated (copy-pasted posts, messages of bots,
+    descriptions of the forums, ...) are only parsed once
+
+    The posts are saved with SENTINEL_UID as uid, which is replaced by a
+    new random uid each time they are returned. The conversion also
+    depends on the ids of the new forum, so a cache must only be used
+    during one dump. The fragments containing links to topics or posts
+    which are not exported yet are not cached (see
+    LinkRewriter.unresolved).
+
+    Attrs:
+        size (int): The maximum number of fragments in the cache (0 to
+            disable it)
+        posts (OrderedDict): The cached posts, from the least recently used
+        hits (int): The number of fragments found in the cache
+        misses (int): The number of fragments converted
+    """
+    def __init__(self, size):
+        self.size = size
+        self.posts = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def convert(self, bb, html):
+        """
+        Returns an html fragment converted to bbcode, with a random uid
+        """
+        if self.size <= 0:
+            self.misses += 1
+            return convert(bb, html)
+
+        key = (html,) + tuple(bb.config[option] for option in CACHE_OPTIONS)
+        try:
+            post = self.posts[key]
+        except KeyError:
+            self.misses += 1
+            unresolved = bb.linkrewriter.unresolved
+            post = convert(bb, html, SENTINEL_UID)
+            if bb.linkrewriter.unresolved == unresolved:
+                self.posts[key] = post
+                if len(self.posts) > self.size:
+                    self.posts.popitem(last=False)
+        else:
+            self.hits += 1
+            self.posts.move_to_end(key)
+
+        uid = random_string()
+        return post._replace(text=post.text.replace(":" + SENTINEL_UID, ":" + uid), uid=uid)
@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Lalf.
+#
+# Lalf is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Lalf is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Lalf.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Module handling the incremental saves of the exported forum
+
+The state of the export is saved in two files: a snapshot of the whole
+tree (save.pickle) and a journal (save.journal) to which a record is
+appended each time a journaled node (see Node.CHECKPOINT) is exported.
+The journal is regularly compacted by writing a new snapshot and
+starting an empty journal. Both files contain the same generation id,
+so that a journal is never replayed on top of another snapshot.
+"""
+
+import io
+import logging
+import os
+import pickle
+import struct
+import tempfile
+import time
+import uuid
+import zlib
+
+from lalf.node import SNAPSHOT, TRANSIENT
+
+SNAPSHOT_FILE = "save.pickle"
+JOURNAL_FILE = "save.journal"
+# Copy of a journal whose records could not all be replayed
+IGNORED_JOURNAL_FILE = "save.journal.ignored"
+
+# Header of the journal (magic number and generation id)
+HEADER = struct.Struct(">8s16s")
+MAGIC = b"LALFJNL1"
+# Header of a record (length and crc32 of the pickled data)
+RECORD = struct.Struct(">II")
+
+# The journal is compacted when it is larger than the snapshot and
+# than this size (in bytes)
+MIN_COMPACTION_SIZE = 1 << 20
+
+class RecordPickler(pickle.Pickler):
+    """
+    Pickler saving the nodes which are not part of a record (ancestors,
+    users and forums) as references to the nodes of the tree
+    """
+    def __init__(self, fileobj, ancestors, shared):
+        pickle.Pickler.__init__(self, fileobj, 2)
+        self.ancestors = ancestors
+        self.shared = shared
+
+    def persistent_id(self, obj):
+        key = id(obj)
+        return self.ancestors.get(key) or self.shared.get(key)
+
+class RecordUnpickler(pickle.Unpickler):
+    """
+    Unpickler resolving the references saved by RecordPickler
+    """
+    def __init__(self, fileobj, bb):
+        pickle.Unpickler.__init__(self, fileobj)
+        self.bb = bb
+
+    def persistent_load(self, pid):
+        kind, key = pid
+        if kind == "node":
+            return node_at(self.bb, key)
+        elif kind == "user":
+            return self.bb.users[key]
+        elif kind == "forum":
+            return self.bb.forums[key]
+        raise pickle.UnpicklingError("Référence inconnue : {}".format(pid))
+
+def dumps_nodes(bb, nodes):
+    """
+    Returns the pickled nodes, the users and forums they refer to being
+    saved as references to the ones of the tree (see loads_nodes)
+    """
+    buf = io.BytesIO()
+    RecordPickler(buf, {}, bb.journal.shared_ids()).dump(nodes)
+    return buf.getvalue()
+
+def loads_nodes(bb, data):
+    """
+    Returns the nodes pickled by dumps_nodes
+    """
+    return RecordUnpickler(io.BytesIO(data), bb).load()
+
+def node_at(bb, path):
+    """
+    Returns the node of the tree at the given path (the indexes of the
+    node and of its ancestors in the children of their parents)
+    """
+    node = bb
+    for index in path:
+        node = node.children[index]
+    return node
+
+class Journal(object):
+    """
+    Object saving the changes made to the tree during the export
+
+    Attrs:
+        bb (BB): The root of the tree
+        dirty (bool): True if the tree contains changes that can only
+            be saved by a snapshot
+        size (int): The size of the journal (in bytes)
+        snapshot_size (int): The size of the last snapshot (in bytes)
+        compacted (float): The time of the last snapshot
+    """
+    def __init__(self, bb):
+        self.logger = logging.getLogger("{}.{}".format(self.__class__.__module__,
+                                                       self.__class__.__name__))
+
+        self.bb = bb
+        self.fileobj = None
+        self.size = 0
+        self.compacted = time.monotonic()
+
+        try:
+            self.snapshot_size = os.path.getsize(SNAPSHOT_FILE)
+        except OSError:
+            self.snapshot_size = 0
+
+        # The tree has never been saved with a journal
+        self.dirty = bb.journal_generation is None
+
+        # References to the users and forums (see shared_ids)
+        self._shared = {}
+        self._shared_sizes = None
+
+    def replay(self):
+        """
+        Apply the records of the journal to the tree loaded from the
+        snapshot, and open the journal to append new records
+        """
+        if self.bb.journal_generation is None:
+            return
+
+        try:
+            fileobj = open(JOURNAL_FILE, "r+b")
+        except FileNotFoundError:
+            self.start()
+            return
+
+        header = fileobj.read(HEADER.size)
+        if (len(header) < HEADER.size
+                or HEADER.unpack(header) != (MAGIC, self.bb.journal_generation)):
+            self.logger.warning("Le journal ne correspond pas à la sauvegarde, il est ignoré.")
+            fileobj.close()
+            self.start()
+            return
+
+        count = 0
+        skipped = 0
+        error = None
+        offset = HEADER.size
+        while True:
+            data = fileobj.read(RECORD.size)
+            if len(data) < RECORD.size:
+                break
+            length, crc = RECORD.unpack(data)
+            payload = fileobj.read(length)
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                self.logger.warning("Fin du journal incomplète, elle est ignorée.")
+                break
+
+            if error is not None:
+                # The next records may depend on the one which could not
+                # be applied
+                skipped += 1
+                continue
+
+            try:
+                self.apply(payload)
+            except (IndexError, KeyError, AttributeError, pickle.UnpicklingError) as e:
+                error = e
+                skipped += 1
+                continue
+
+            count += 1
+            offset += RECORD.size + length
+
+        self.logger.info("%d enregistrements du journal rejoués.", count)
+
+        if error is not None:
+            # The records are valid, so the journal is kept, and the
+            # tree in its current state is saved in a new generation
+            self.logger.warning("Impossible de rejouer le journal (%r), %d enregistrements "
+                                "ignorés (conservés dans %s).",
+                                error, skipped, IGNORED_JOURNAL_FILE)
+            fileobj.close()
+            os.replace(JOURNAL_FILE, IGNORED_JOURNAL_FILE)
+            self.compact()
+            return
+
+        # Remove the incomplete records
+        fileobj.seek(offset)
+        fileobj.truncate()
+        self.fileobj = fileobj
+        self.size = offset
+
+    def apply(self, payload):
+        """
+        Restore the state of a node saved in a record
+        """
+        path, state, data = RecordUnpickler(io.BytesIO(payload), self.bb).load()
+        node = node_at(self.bb, path)
+        node.__setstate__(state)
+        # Set the scope of the children of the node
+        node.set_scope(node.scope)
+        node._replay_(data) # pylint: disable=protected-access
+
+    def start(self):
+        """
+        Start a new empty journal for the current generation
+        """
+        if self.fileobj is not None:
+            self.fileobj.close()
+
+        fd, tmppath = tempfile.mkstemp(dir=".")
+        with os.fdopen(fd, "wb") as fileobj:
+            fileobj.write(HEADER.pack(MAGIC, self.bb.journal_generation))
+        os.replace(tmppath, JOURNAL_FILE)
+
+        self.fileobj = open(JOURNAL_FILE, "ab")
+        self.size = HEADER.size
+
+    def shared_ids(self):
+        """
+        Returns the references to the users and forums, which are
+        referenced by the posts and the forums
+        """
+        sizes = (len(self.bb.users), len(self.bb.forums))
+        if sizes != self._shared_sizes:
+            self._shared = {}
+            for oldid, user in self.bb.users.items():
+                self._shared[id(user)] = ("user", oldid)
+            for oldid, forum in self.bb.forums.items():
+                self._shared[id(forum)] = ("forum", oldid)
+            self._shared_sizes = sizes
+        return self._shared
+
+    def append(self, node, path):
+        """
+        Append a record containing the state of a node to the journal
+        """
+        # References to the node and its ancestors
+        ancestors = {id(self.bb): ("node", ())}
+        current = self.bb
+        for depth, index in enumerate(path):
+            current = current.children[index]
+            ancestors[id(current)] = ("node", path[:depth+1])
+
+        buf = io.BytesIO()
+        pickler = RecordPickler(buf, ancestors, self.shared_ids())
+        pickler.dump((path, node.__getstate__(), node._journal_())) # pylint: disable=protected-access
+        payload = buf.getvalue()
+
+        self.fileobj.write(RECORD.pack(len(payload), zlib.crc32(payload)) + payload)
+        self.fileobj.flush()
+        self.size += RECORD.size + len(payload)
+
+    def record(self, node, path):
+        """
+        Save the changes made by the export of a node (see Node.CHECKPOINT)
+        """
+        if node.CHECKPOINT == TRANSIENT:
+            return
+
+        if node.CHECKPOINT == SNAPSHOT:
+            self.dirty = True
+            interval = self.bb.config["checkpoint_interval"]
+            if interval > 0 and time.monotonic() - self.compacted >= interval:
+                self.compact()
+            return
+
+        if self.dirty:
+            # The record would depend on changes that are not saved yet
+            self.compact()
+            return
+
+        self.append(node, path)
+        if self.size > max(self.snapshot_size, MIN_COMPACTION_SIZE):
+            self.compact()
+
+    def compact(self):
+        """
+        Write a snapshot of the whole tree and start a new journal
+        """
+        self.logger.info("Sauvegarde de l'état courant.")
+
+        # The snapshot may refer to posts saved in the store
+        if self.bb.store is not None:
+            self.bb.store.commit()
+
+        generation = self.bb.journal_generation
+        self.bb.journal_generation = uuid.uuid4().bytes
+
+        fd, tmppath = tempfile.mkstemp(dir=".")
+        try:
+            with os.fdopen(fd, "wb") as fileobj:
+                pickle.dump(self.bb, fileobj, 2)
+            os.replace(tmppath, SNAPSHOT_FILE)
+        except BaseException:
+            self.bb.journal_generation = generation
+            os.remove(tmppath)
+            raise
+
+        self.snapshot_size = os.path.getsize(SNAPSHOT_FILE)
+        self.start()
+        self.dirty = False
+        self.compacted = time.monotonic()
+
+    def flush(self):
+        """
+        Make sure the records of the journal are written on the disk
+        """
+        if self.fileobj is not None:
+            self.fileobj.flush()
+            os.fsync(self.fileobj.fileno())
+
+    def close(self):
+        """
+        Close the journal
+        """
+        if self.fileobj is not None:
+            self.fileobj.close()
+            self.fileobj = None
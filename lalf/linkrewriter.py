@@ -20,14 +20,35 @@ Module handling the rewriting of internal links
 """
 
 import re
+from collections import OrderedDict
 from urllib.parse import urlparse, parse_qs
 
+# Number of rewritten urls kept by each LinkRewriter
+CACHE_SIZE = 4096
+
 class LinkRewriter(object):
     """
     Object used to rewrite internal links
+
+    The results are cached, since the ids of the users and forums do not
+    change once the links are rewritten. With the stream_dump option, the
+    links to the topics and posts which are not exported yet are rewritten
+    without their forum and topic (see topic_path): these ones are not
+    cached, so that they are complete once the topics are exported.
+
+    Attrs:
+        bb (BB): The BB object containing the exported forum
+        urls (OrderedDict): The cached rewritten urls, from the least
+            recently used
+        unresolved (int): The number of rewritten links to topics or
+            posts which were not in the indexes
     """
     handlers = []
 
+    # Regular expression matching the paths matched by any handler, with
+    # a named group for each handler (see rewrite)
+    dispatcher = None
+
     @classmethod
     def handler(cls, regex, required_params=None):
         """
@@ -58,14 +79,22 @@ class LinkRewriter(object):
 
         .. _Match object:
             https://docs.python.org/3/library/re.html#match-objects
+
+        The regular expression must not contain named groups, since it
+        is also part of LinkRewriter.dispatcher.
         """
         def decorator(handler): # pylint: disable=missing-docstring
             cls.handlers.append((re.compile(regex), handler, required_params or []))
+            cls.dispatcher = re.compile("|".join(
+                "(?P<handler{}>{})".format(index, regex.pattern)
+                for index, (regex, _, _) in enumerate(cls.handlers)))
             return handler
         return decorator
 
     def __init__(self, bb):
         self.bb = bb
+        self.urls = OrderedDict()
+        self.unresolved = 0
 
     def rewrite(self, url):
         """
@@ -78,19 +107,94 @@ class LinkRewriter(object):
             (str): A link to the corresponding page in the new forum or
                 None if there is no rewriting handler for this url
         """
+        try:
+            newurl = self.urls[url]
+        except KeyError:
+            pass
+        else:
+            self.urls.move_to_end(url)
+            return newurl
+
+        unresolved = self.unresolved
+        newurl = self.rewrite_url(url)
+        if self.unresolved == unresolved:
+            self.urls[url] = newurl
+            if len(self.urls) > CACHE_SIZE:
+                self.urls.popitem(last=False)
+        return newurl
+
+    def rewrite_url(self, url):
+        """
+        Rewrite an internal link, without using the cache (see rewrite)
+        """
         _, netloc, path, params, query, fragment = urlparse(url)
 
         if netloc != self.bb.config["url"]:
             return None
 
-        for (regex, handler, required_params) in self.__class__.handlers:
-            params = parse_qs(query)
+        # Find the first handler whose regular expression matches the
+        # path, without trying the regular expressions one by one
+        match = self.dispatcher.fullmatch(path)
+        if match is None:
+            return None
+        first = int(match.lastgroup[len("handler"):])
+
+        params = parse_qs(query)
+        for (regex, handler, required_params) in self.handlers[first:]:
+            # The next handlers are used if the required parameters are
+            # missing or if the handler cannot rewrite the url
             match = regex.fullmatch(path)
             if match and all(param in params for param in required_params):
                 newpath = handler(self.bb, match, params, fragment)
                 if newpath:
                     return self.bb.config["phpbb_url"] + newpath
 
+def topic_path(bb, topic_id, post_id=None):
+    """
+    Returns the path of a topic, or of one of its posts, in the new forum
+
+    The topic of the post and the forum of the topic are added to the
+    path when they are known (see BB.topics_index and BB.posts_index), so
+    that phpbb does not have to look for them. The link is counted in
+    bb.linkrewriter.unresolved otherwise.
+
+    Args:
+        topic_id (int): The id of the topic (or None if only the id of
+            the post is known)
+        post_id (int): The id of the post (or None)
+    """
+    resolved = True
+    if post_id is not None:
+        resolved = post_id in bb.posts_index
+        topic_id = bb.posts_index.get(post_id, topic_id)
+
+    params = []
+    if topic_id is not None:
+        forum_id = bb.topics_index.get(topic_id)
+        if forum_id is not None:
+            params.append("f={}".format(forum_id))
+        else:
+            resolved = False
+        params.append("t={}".format(topic_id))
+
+    if not resolved:
+        bb.linkrewriter.unresolved += 1
+
+    if post_id is None:
+        return "/viewtopic.php?{}".format("&".join(params))
+
+    params.append("p={}".format(post_id))
+    return "/viewtopic.php?{}#p{}".format("&".join(params), post_id)
+
+def post_id_from_fragment(fragment):
+    """
+    Returns the id of the post in the fragment of a url (or None)
+    """
+    try:
+        return int(fragment)
+    except ValueError:
+        return None
+
 @LinkRewriter.handler(r"")
 @LinkRewriter.handler(r"/")
 @LinkRewriter.handler(r"/forum")
@@ -131,14 +235,7 @@ def topic_handler(bb, match, params, fragment):
     /...-t<id>.htm
     /...-t<id>-<page>.htm
     """
-    try:
-        post_id = int(fragment)
-    except ValueError:
-        pass
-    else:
-        return "/viewtopic.php?p={post}#p{post}".format(post=post_id)
-
-    return "/viewtopic.php?f={}".format(match.group(1))
+    return topic_path(bb, int(match.group(1)), post_id_from_fragment(fragment))
 
 @LinkRewriter.handler(r"/viewtopic.forum", ["t"])
 def viewtopic_handler(bb, match, params, fragment):
@@ -147,7 +244,12 @@ def viewtopic_handler(bb, match, params, fragment):
 
     /viewtopic.forum?t=<id>
     """
-    return "/viewtopic.php?t={post}".format(post=params["t"][0])
+    try:
+        topic_id = int(params["t"][0])
+    except ValueError:
+        return None
+
+    return topic_path(bb, topic_id, post_id_from_fragment(fragment))
 
 @LinkRewriter.handler(r"/.*-p(\d+).htm")
 def post_handler(bb, match, params, fragment):
@@ -156,7 +258,7 @@ def post_handler(bb, match, params, fragment):
 
     /...-p<id>.htm
     """
-    return "/viewtopic.php?p={post}#p{post}".format(post=match.group(1))
+    return topic_path(bb, None, int(match.group(1)))
 
 @LinkRewriter.handler(r"/viewtopic.forum", ["p"])
 def viewpost_handler(bb, match, params, fragment):
@@ -165,7 +267,12 @@ def viewpost_handler(bb, match, params, fragment):
 
     /viewtopic.forum?p=<id>
     """
-    return "/viewtopic.php?p={post}#p{post}".format(post=params["p"][0])
+    try:
+        post_id = int(params["p"][0])
+    except ValueError:
+        return None
+
+    return topic_path(bb, None, post_id)
 
 @LinkRewriter.handler(r"/u(\d+)")
 def user_handler(bb, match, params, fragment):
@@ -19,23 +19,105 @@
 Module defining the Node base class
 """
 
+import asyncio
+import functools
 import logging
 
+# How the changes made by the _export_ method of a node are saved (see
+# Node.CHECKPOINT and lalf.journal)
+SNAPSHOT = 0
+JOURNAL = 1
+TRANSIENT = 2
+
+# Scope of the nodes which have no exposing ancestor (see Node.scope)
+EMPTY_SCOPE = {}
+
+class ExposedAttribute(object):
+    """
+    Descriptor giving access to an attribute exposed by an ancestor of
+    a node (see Node.expose)
+
+    Since it does not define __set__, the attributes of the node itself
+    take precedence over it.
+
+    Attrs:
+        name (str): The name of the exposed attribute
+    """
+    __slots__ = ["name"]
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, node, cls=None):
+        if node is None:
+            return self
+
+        try:
+            obj, attr = node.scope[self.name]
+        except KeyError:
+            raise AttributeError(
+                "'{}' object has no attribute '{}'".format(cls.__name__, self.name))
+
+        if attr == "self":
+            return obj
+        else:
+            return getattr(obj, attr)
+
+@functools.lru_cache(maxsize=None)
+def slot_descriptors(cls):
+    """
+    Returns the descriptors of the slots of a class and of its bases, by
+    name
+    """
+    slots = {}
+    for base in reversed(cls.__mro__):
+        for name in base.__dict__.get("__slots__", ()):
+            slots[name] = base.__dict__[name]
+    return slots
+
+def downloads_pages(nodes):
+    """
+    Returns True if some of the nodes may download a page when they are
+    exported (the other ones never need to be prefetched, see Node._path_)
+    """
+    return any(node.__class__._path_ is not Node._path_ for node in nodes)
+
 class Node(object):
     """
     Node of the forum.
 
+    The nodes which are numerous (posts, topics and pages) define
+    __slots__ to save memory, so the attributes of a node should be
+    accessed with getattr and setattr rather than through __dict__.
+
     Attrs:
-       children (List[Node]): The children of the node
-       exposed_attrs (Dict(str, (Node, str))): Dictionnary containing the attributes
+       children (List[Node]): The children of the node (an empty tuple
+           until the first child is added)
+       scope (Dict(str, (Node, str))): Dictionnary containing the attributes
            exposed by parent nodes. This should not be used directly, see @Node.expose.
+           It is shared by the children of a node and must not be modified. It is
+           not saved, but rebuilt when the tree is loaded (see set_scope).
        exported (bool): True if the node has been exported
     """
+    __slots__ = ["children", "scope", "exported"]
 
     # Attributes to save
-    NODE_KEEP = ["children", "exposed_attrs", "exported"]
+    NODE_KEEP = ["children", "exported"]
     STATE_KEEP = []
 
+    # Values of the attributes missing from the states saved by older
+    # versions (class attributes cannot be used as default values
+    # with __slots__)
+    STATE_DEFAULTS = {}
+
+    logger = logging.getLogger("lalf.node.Node")
+
+    # How the changes made by _export_ are saved: in the next snapshot
+    # of the whole tree (SNAPSHOT), in a record of the journal
+    # containing the state of the node (JOURNAL), or not at all if they
+    # can be recomputed (TRANSIENT)
+    CHECKPOINT = SNAPSHOT
+
     # Attributes exposed to the node's children (used by @Node.expose decorator)
     EXPOSE = []
 
@@ -69,51 +151,137 @@ class Node(object):
         """
         def decorator(cls):
             cls.EXPOSE = [(attr, attr) for attr in args] + list(kwargs.items())
+            for _, name in cls.EXPOSE:
+                if not hasattr(Node, name):
+                    setattr(Node, name, ExposedAttribute(name))
             return cls
         return decorator
 
-    def __init__(self):
-        self.logger = logging.getLogger("{}.{}".format(self.__class__.__module__,
-                                                       self.__class__.__name__))
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.logger = logging.getLogger("{}.{}".format(cls.__module__, cls.__name__))
 
-        self.children = []
-        self.exposed_attrs = {}
+    def __init__(self):
+        self.children = ()
+        self.scope = EMPTY_SCOPE
 
         self.exported = False
 
-    def __getattr__(self, name):
-        if name == "exposed_attrs" or name not in self.exposed_attrs:
-            raise AttributeError(
-                "'{}' object has no attribute '{}'".format(self.__class__.__name__, name))
+    def child_scope(self):
+        """
+        Returns a new scope for the children of the node
+        """
+        if not self.EXPOSE:
+            return self.scope
 
-        obj, attr = self.exposed_attrs[name]
-        if attr == "self":
-            return obj
-        else:
-            return getattr(obj, attr)
+        scope = dict(self.scope)
+        for attr, name in self.EXPOSE:
+            scope[name] = (self, attr)
+        return scope
+
+    def set_scope(self, scope):
+        """
+        Set the scope of the node and of its descendants (used when the
+        tree is loaded)
+        """
+        self.scope = scope
+        if self.children:
+            scope = self.child_scope()
+            for child in self.children:
+                child.set_scope(scope)
 
     def add_child(self, child):
         """
         Add a child to the node
         """
+        if self.children:
+            # All the children share the same scope
+            child.scope = self.children[0].scope
+        else:
+            self.children = []
+            child.scope = self.child_scope()
         self.children.append(child)
 
-        child.exposed_attrs.update(self.exposed_attrs)
-        for attr, name in self.__class__.EXPOSE:
-            child.exposed_attrs[name] = (self, attr)
-
-    def export(self):
+    def export(self, path=()):
         """
         Export the node and its children (this method calls the _export_
         method and should not be overwritten)
+
+        Args:
+            path (Tuple(int)): The indexes of the node and of its
+                ancestors in the children of their parents
         """
         if not self.exported:
-            self.children = []
+            self.children = ()
             self._export_()
             self.exported = True
+            self._checkpoint_(path)
 
-        for child in self.children:
-            child.export()
+        children = self.children
+        window = self.session.window if downloads_pages(children) else 0
+        prefetched = []
+        try:
+            for sibling in children[:window - 1]:
+                prefetched.append(sibling.prefetch())
+
+            for index, child in enumerate(children):
+                # Download the page of the child entering the window in the
+                # background while this one is exported (the previous ones
+                # are already being downloaded)
+                if window and index + window - 1 < len(children):
+                    prefetched.append(children[index + window - 1].prefetch())
+
+                child.export(path + (index,))
+        finally:
+            # Do not wait for the pages of the next children if the
+            # export of a child failed
+            self.session.cancel(prefetched)
+
+        self._finish_()
+
+    async def export_async(self, path=()):
+        """
+        Export the node and its children like export, but download the
+        pages of the children concurrently with the asynchronous session
+        (see lalf.asyncsession)
+
+        The _export_ and _checkpoint_ methods, which are synchronous, are
+        run in another thread, so that the downloads go on meanwhile (the
+        pages they download are forwarded to the asynchronous session,
+        see Session.forward).
+        """
+        if not self.exported:
+            loop = asyncio.get_running_loop()
+            self.children = ()
+            await loop.run_in_executor(None, self._export_)
+            self.exported = True
+            await loop.run_in_executor(None, self._checkpoint_, path)
+
+        children = self.children
+        window = self.async_session.window if downloads_pages(children) else 0
+        downloads = {}
+        try:
+            for index, child in enumerate(children):
+                # Download the pages of the next children while this one is
+                # exported (only the ones which actually need a page)
+                if window:
+                    first = index + window - 1 if index else 0
+                    for sibling in children[first:index + window]:
+                        if not sibling.exported and sibling._path_() is not None:
+                            downloads[sibling] = asyncio.ensure_future(sibling.prefetch_async())
+
+                download = downloads.pop(child, None)
+                if download is not None:
+                    await download
+                await child.export_async(path + (index,))
+        finally:
+            # Do not leave downloads running (or failing unnoticed) if
+            # the export of a child failed
+            for download in downloads.values():
+                download.cancel()
+            await asyncio.gather(*downloads.values(), return_exceptions=True)
+
+        self._finish_()
 
     def _export_(self):
         """
@@ -125,19 +293,101 @@ class Node(object):
         """
         return
 
+    def _finish_(self):
+        """
+        Called once the node and all its descendants have been exported
+        (in each run, even if they were exported by a previous one)
+        """
+        return
+
+    def _checkpoint_(self, path):
+        """
+        Save the changes made by _export_ (see CHECKPOINT)
+        """
+        self.root.journal.record(self, path)
+
+    def _journal_(self):
+        """
+        Returns the data needed to replay the export of the node, in
+        addition to its state, or None (see _replay_).
+
+        This should be overwritten by the journaled nodes whose _export_
+        method modifies other nodes.
+        """
+        return None
+
+    def _replay_(self, data):
+        """
+        Apply the changes made by _export_ to other nodes again, when the
+        state of the node is restored from the journal
+
+        Args:
+            data: The value returned by _journal_ when the node was exported
+        """
+        return
+
+    def prefetch(self):
+        """
+        Start downloading the page needed to export the node (see
+        _path_) in the background, if it has not been exported yet
+
+        Returns:
+            (str): The path of the page, or None
+        """
+        if not self.exported:
+            path = self._path_()
+            if path is not None:
+                self.session.prefetch(path)
+            return path
+        return None
+
+    async def prefetch_async(self):
+        """
+        Download the page needed to export the node (see _path_) with the
+        asynchronous session, if it has not been exported yet
+        """
+        if not self.exported:
+            path = self._path_()
+            if path is not None:
+                response = await self.async_session.get(path)
+                self.session.store(path, response)
+
+    def _path_(self):
+        """
+        Returns the path of the page of the forum downloaded by _export_
+        (without any parameter), or None.
+
+        The pages of independent nodes can then be downloaded
+        concurrently. The tree is still exported in the same order.
+        """
+        return None
+
     def __getstate__(self):
-        odict = self.__dict__.copy()
+        odict = {}
 
-        for k in self.__dict__:
-            if not (k in self.NODE_KEEP or k in self.STATE_KEEP):
-                del odict[k]
+        # Read the attributes of the node itself, in its slots or its
+        # __dict__: a generic lookup would return the attributes exposed
+        # by its ancestors (see ExposedAttribute) when they are not set
+        values = getattr(self, "__dict__", EMPTY_SCOPE)
+        slots = slot_descriptors(self.__class__)
+        for k in self.NODE_KEEP + self.STATE_KEEP:
+            if k in values:
+                odict[k] = values[k]
+            elif k in slots:
+                try:
+                    odict[k] = slots[k].__get__(self)
+                except AttributeError:
+                    pass
 
         return odict
 
     def __setstate__(self, state):
-        self.__dict__.update(state)
-        self.logger = logging.getLogger("{}.{}".format(self.__class__.__module__,
-                                                       self.__class__.__name__))
+        for k, value in self.STATE_DEFAULTS.items():
+            setattr(self, k, value)
+        for k, value in state.items():
+            # The exposed attributes were saved by older versions
+            if k != "exposed_attrs":
+                setattr(self, k, value)
 
     def dump(self, sqlfile):
         """
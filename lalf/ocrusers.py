@@ -187,6 +187,10 @@ class OcrUser(User):
         Let the user confirm the email address if it could not be
         validated
         """
+        if self.trust < 3:
+            # The address will be modified
+            self.root.journal.dirty = True
+
         if self.trust == 2:
             self.logger.info(
                 "L'adresse email de l'utilisateur %s est probablement valide "
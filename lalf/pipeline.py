@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Lalf.
+#
+# Lalf is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Lalf is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Lalf.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Module handling the writing of the sql dump during the exportation
+"""
+
+import logging
+import queue
+import threading
+
+from lalf.node import Node
+from lalf.statistics import Statistics
+
+class DumpPipeline(object):
+    """
+    Object writing the topics in the sql dump file as soon as they are
+    exported (see Topic._finish_), in a background thread, so that the
+    conversion of the posts to bbcode is done while the next pages are
+    downloaded.
+
+    The rows that depend on the whole forum (users, forums,
+    configuration, ...) are written at the end by BB.dump, which skips
+    the topics. Since the whole tree is walked again when the exportation
+    is resumed, every topic is written once in each run, and the dump
+    file is complete after the last one.
+
+    Once written, the pages of a topic are moved to the store (see
+    Topic.release): only its statistics are kept in memory until the
+    end of the dump. They are read from the store again when the topic
+    is written by the next run.
+
+    Attrs:
+        bb (BB): The root of the tree
+        sqlfile (SqlFile): The dump file
+        stats (Statistics): The statistics of the topics written so far
+        error (BaseException): The exception raised by the background
+            thread, if any
+    """
+    def __init__(self, bb, sqlfile):
+        self.logger = logging.getLogger("{}.{}".format(self.__class__.__module__,
+                                                       self.__class__.__name__))
+
+        self.bb = bb
+        self.sqlfile = sqlfile
+        self.stats = Statistics()
+        self.error = None
+
+        self.queue = queue.Queue()
+        self.cancelled = False
+        self.thread = threading.Thread(target=self.run, name="dump", daemon=True)
+
+    def start(self):
+        """
+        Write the beginning of the dump file and start the background thread
+        """
+        self.logger.info("Création du fichier phpbb.sql pendant l'exportation")
+        self.bb.truncate_tables(self.sqlfile)
+        self.bb.stats = self.stats
+        self.thread.start()
+
+    def put(self, topic):
+        """
+        Add an exported topic to the dump file
+        """
+        if self.error is not None:
+            raise self.error
+        self.queue.put(topic)
+
+    def run(self):
+        """
+        Write the topics added with put (run in the background thread)
+        """
+        while True:
+            topic = self.queue.get()
+            if topic is None or self.cancelled:
+                return
+
+            try:
+                topic.restore()
+                self.stats.add_topic(topic.forum, topic)
+                # Topic.dump does nothing while the pipeline is used
+                Node.dump(topic, self.sqlfile)
+                topic.release()
+            except BaseException as e: # pylint: disable=broad-except
+                self.logger.exception("Erreur lors de l'écriture du sujet %d", topic.topic_id)
+                self.error = e
+                return
+
+    def finish(self):
+        """
+        Wait until all the exported topics have been written
+        """
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def cancel(self):
+        """
+        Stop the background thread without writing the remaining topics
+        """
+        self.logger.warning("L'exportation a été interrompue : le fichier phpbb.sql est "
+                            "incomplet, il sera recréé lors de la prochaine exécution.")
+        self.cancelled = True
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.sqlfile.close()
@@ -19,14 +19,14 @@
 Module handling the exportation of the posts
 """
 
+import functools
 import re
 
 from pyquery import PyQuery
 
-from lalf.node import Node
+from lalf.node import Node, JOURNAL, TRANSIENT
 from lalf.util import parse_date, clean_url
 from lalf.users import AnonymousUser, NoUser
-from lalf import htmltobbcode
 
 class NoPost(object):
     def __init__(self):
@@ -42,13 +42,20 @@ class Post(Node):
 
     Attrs:
         post_id (int): The id of the post
-        text (str): The content of the post in html
+        text (str): The content of the post in html, or None if it has
+            been moved to the store (see lalf.store and get_text)
         title (str): The title of the post
         time (int): Time of the post (unix timestamp)
         poster (User): User who submitted the post
     """
+    __slots__ = ["post_id", "text", "title", "time", "poster"]
+
     STATE_KEEP = ["post_id", "text", "title", "time", "poster"]
 
+    # The post is saved with its page, only the counters and the store
+    # are updated (and the store is committed before each snapshot)
+    CHECKPOINT = TRANSIENT
+
     def __init__(self, post_id, text, title, post_time, poster):
         Node.__init__(self)
         self.post_id = post_id
@@ -58,15 +65,35 @@ class Post(Node):
         self.poster = poster
 
     def _export_(self):
+        if self.config["use_sqlite"] and self.text is not None:
+            # Keep the content of the post on the disk only
+            self.root.store.set_text(self.post_id, self.topic.topic_id, self.poster.newid,
+                                     self.text)
+            self.text = None
+
         self.root.current_posts += 1
         self.ui.update()
 
+    def get_text(self):
+        """
+        Returns the content of the post in html
+        """
+        if self.text is None:
+            return self.root.store.get_text(self.post_id)
+        return self.text
+
     def _dump_(self, sqlfile):
         self.logger.debug("Exportation du message %d (sujet %d)", self.post_id, self.topic.topic_id)
-        parser = htmltobbcode.Parser(self.root)
-        parser.feed(self.text)
-        post = parser.get_post()
+        self.root.converter.convert(self.get_text(), functools.partial(self.write, sqlfile))
+
+    def write(self, sqlfile, post):
+        """
+        Write the post in the dump file
 
+        Args:
+            post (BBCodePost): The content of the post converted to
+                bbcode (see lalf.conversion)
+        """
         sqlfile.insert("posts", {
             "post_id" : self.post_id,
             "topic_id" : self.topic.topic_id,
@@ -82,41 +109,56 @@ class Post(Node):
 class TopicPage(Node):
     """
     Node representing a page of a topic
+
+    Attrs:
+        page (int): The index of the first post of the page
+        html (str): The source of the page, if it has already been
+            downloaded (it is dropped once the page is exported)
     """
     # Attributes to save
-    STATE_KEEP = ["page"]
+    __slots__ = ["page", "html"]
+
+    STATE_KEEP = ["page", "html"]
+    STATE_DEFAULTS = {"html": None}
+
+    CHECKPOINT = JOURNAL
 
-    def __init__(self, page):
+    def __init__(self, page, html=None):
         Node.__init__(self)
         self.page = page
+        self.html = html
 
     def _export_(self):
         self.logger.debug('Récupération des messages du sujet %d (page %d)',
                           self.topic.topic_id, self.page)
 
-        response = self.session.get("/t{}p{}-a".format(self.topic.topic_id, self.page))
-        document = PyQuery(response.text)
+        if self.html is None:
+            self.html = self.session.get(self._path_()).text
+        document = PyQuery(self.html)
+        self.html = None
 
         pattern = re.compile(r"/u(\d+)")
+        topic_id = self.topic.topic_id
+        users = self.users
+        index_post = self.root.index_post
 
         for element in document.find('tr.post'):
             e = PyQuery(element)
 
             post_id = int(e("td span.name a").attr("name"))
 
-            self.logger.info('Récupération du message %d (sujet %d)',
-                             post_id, self.topic.topic_id)
+            self.logger.info('Récupération du message %d (sujet %d)', post_id, topic_id)
 
             match = pattern.fullmatch(clean_url(e("td span.name strong a").eq(0).attr("href") or ""))
             if match:
-                poster = self.users[int(match.group(1))]
+                poster = users[int(match.group(1))]
             else:
                 poster = AnonymousUser()
 
             post = e("td div.postbody div").eq(0).html()
             if not post:
                 self.logger.warning('Le message  %d (sujet %d) semble être vide',
-                                    post_id, self.topic.topic_id)
+                                    post_id, topic_id)
                 post = ""
 
             # Get title
@@ -128,3 +170,25 @@ class TopicPage(Node):
             timestamp = parse_date(e("table td span.postdetails").contents()[3])
 
             self.add_child(Post(post_id, post, title, timestamp, poster))
+            index_post(post_id, topic_id)
+
+    def _replay_(self, data):
+        # The posts are not in the journal (see Post.CHECKPOINT), but
+        # they are restored with the page: mark them as exported, moving
+        # their content to the store if it was not committed before the
+        # interruption
+        use_sqlite = self.config["use_sqlite"]
+        if use_sqlite:
+            topic_id = self.topic.topic_id
+            self.root.store.add_texts([
+                (post.post_id, topic_id, post.poster.newid, post.text)
+                for post in self.children if post.text is not None])
+        for post in self.children:
+            post.exported = True
+            if use_sqlite:
+                post.text = None
+
+    def _path_(self):
+        if self.html is not None:
+            return None
+        return "/t{}p{}-a".format(self.topic.topic_id, self.page)
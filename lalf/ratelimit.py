@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Lalf.
+#
+# Lalf is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Lalf is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Lalf.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Module limiting the rate of the requests sent to the forum
+"""
+
+import asyncio
+import logging
+import random
+import threading
+import time
+
+# Delay between two attempts to start a request when too many requests
+# are running
+POLL_INTERVAL = 0.05
+
+class RateLimiter(object):
+    """
+    Object limiting the rate and the number of simultaneous requests
+
+    The rate is limited by a token bucket which holds at most one second
+    of requests. The number of simultaneous requests is adjusted with an
+    AIMD scheme: it grows by one request each time a whole window of
+    requests succeeds, and it is halved when the forum throttles the
+    requests or responds too slowly. When the forum throttles the
+    requests, no request is sent for a random delay which grows
+    exponentially with the number of consecutive failures (see backoff).
+
+    The methods never block while holding the lock, so that the same
+    object can be used by the threads of lalf.session.Session (acquire)
+    and by the coroutines of lalf.asyncsession.AsyncSession
+    (acquire_async).
+
+    Attrs:
+        rate (float): The maximum number of requests per second (0 if
+            the rate is not limited)
+        max_concurrency (int): The maximum number of simultaneous requests
+        concurrency (float): The current limit of simultaneous requests
+        active (int): The number of requests being sent
+        tokens (float): The number of requests that can be sent right now
+        failures (int): The number of consecutive throttled requests
+        paused_until (float): The time before which no request should be sent
+        decreased (float): The time of the last decrease of concurrency
+    """
+    def __init__(self, config):
+        self.logger = logging.getLogger("{}.{}".format(self.__class__.__module__,
+                                                       self.__class__.__name__))
+
+        self.rate = config["requests_per_second"]
+        self.backoff_base = config["backoff_base"]
+        self.backoff_max = config["backoff_max"]
+        self.latency_threshold = config["latency_threshold"]
+
+        self.max_concurrency = max(1, config["max_connections"])
+        self.concurrency = float(self.max_concurrency)
+        self.active = 0
+
+        self.tokens = max(1.0, self.rate)
+        self.updated = time.monotonic()
+
+        self.failures = 0
+        self.paused_until = 0.0
+        self.decreased = 0.0
+
+        self.lock = threading.Lock()
+
+    def backoff(self, failures):
+        """
+        Returns a random delay (in seconds) to wait after failures
+        consecutive failures ("full jitter" exponential backoff)
+        """
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** failures))
+
+    def reserve(self):
+        """
+        Try to start a request
+
+        Returns:
+            (float, float): A pair (start, delay). If delay is 0, the
+                request can be sent and release must be called with start
+                once it is done. Otherwise, reserve should be called again
+                after delay seconds.
+        """
+        with self.lock:
+            now = time.monotonic()
+            delay = self.paused_until - now
+
+            if self.rate > 0:
+                self.tokens = min(max(1.0, self.rate),
+                                  self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens < 1:
+                    delay = max(delay, (1 - self.tokens) / self.rate)
+
+            if self.active >= int(self.concurrency):
+                delay = max(delay, POLL_INTERVAL)
+
+            if delay > 0:
+                return now, delay
+
+            if self.rate > 0:
+                self.tokens -= 1
+            self.active += 1
+            return now, 0
+
+    def acquire(self):
+        """
+        Wait until a request can be sent
+
+        Returns:
+            (float): The value that should be given to release
+        """
+        while True:
+            start, delay = self.reserve()
+            if delay == 0:
+                return start
+            time.sleep(delay)
+
+    async def acquire_async(self):
+        """
+        Wait until a request can be sent (coroutine version of acquire)
+        """
+        while True:
+            start, delay = self.reserve()
+            if delay == 0:
+                return start
+            await asyncio.sleep(delay)
+
+    def release(self, start, throttled=False, retry_after=None, cancelled=False):
+        """
+        Signal the end of a request and adapt the limits
+
+        Args:
+            start (float): The value returned by acquire
+            throttled (bool): True if the forum refused to answer the
+                request (see BaseSession.throttled)
+            retry_after (float): The delay requested by the forum before
+                the next request, if any
+            cancelled (bool): True if no response was received (the
+                request was cancelled or failed): the limits are not
+                changed
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.active -= 1
+
+            if cancelled:
+                return
+
+            slow = self.latency_threshold > 0 and now - start > self.latency_threshold
+
+            if throttled or slow:
+                # Only decrease once for the requests which were sent
+                # before the previous decrease
+                if start >= self.decreased:
+                    self.concurrency = max(1.0, self.concurrency / 2)
+                    self.decreased = now
+                    self.logger.debug("Réduction du nombre de connexions simultanées à %d",
+                                      int(self.concurrency))
+            else:
+                self.concurrency = min(float(self.max_concurrency),
+                                       self.concurrency + 1 / self.concurrency)
+
+            if throttled:
+                delay = self.backoff(self.failures)
+                if retry_after is not None:
+                    delay = max(delay, min(self.backoff_max, retry_after))
+                self.failures += 1
+                self.paused_until = max(self.paused_until, now + delay)
+                self.logger.info("Le forum limite les requêtes, attend %.1f secondes.", delay)
+            else:
+                self.failures = 0
@@ -19,12 +19,32 @@
 Module handling the connections to the forum
 """
 
+import asyncio
 import logging
+import re
 import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
 from urllib.parse import urlparse, urlunparse
 
 import requests
-from pyquery import PyQuery
+
+from lalf.cache import Cache, NotInCache
+from lalf.ratelimit import RateLimiter
+
+# Link to the login page and class of the links of the main menu, used
+# to check that the user is connected without parsing the whole page
+LOGIN_HREF = re.compile(r"""\bhref\s*=\s*(?:"/login"|'/login'|/login(?=[\s>]))""", re.I)
+MAINMENU_CLASS = re.compile(
+    r"""\bclass\s*=\s*(?:"[^"]*(?<![\w-])mainmenu(?![\w-])[^"]*"|"""
+    r"""'[^']*(?<![\w-])mainmenu(?![\w-])[^']*'|mainmenu(?=[\s>]))""", re.I)
+
+# Number of latencies used to compute the hedging delay (see
+# BaseSession.hedge_delay)
+LATENCY_SAMPLES = 200
+# Number of latencies needed before requests are hedged
+MIN_LATENCY_SAMPLES = 20
 
 class UnableToConnect(Exception):
     """
@@ -34,17 +54,53 @@ class UnableToConnect(Exception):
     def __str__(self):
         return "Impossible de se connecter. Vérifiez les identifiants de l'administrateur"
 
-class Session(object):
+def make_response(url, status_code, headers, content):
     """
-    Object handling the connections to the forum
+    Create a requests.Response object from the data of a response received
+    by other means (so that the nodes can use it as usual)
+    """
+    response = requests.Response()
+    response.url = url
+    response.status_code = status_code
+    response.headers = requests.structures.CaseInsensitiveDict(headers)
+    response._content = content # pylint: disable=protected-access
+    response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+    return response
+
+class BaseSession(object):
+    """
+    Methods shared by the synchronous and asynchronous sessions
+
+    Attrs:
+        cache (Cache): The persistent cache of the responses (or None)
+        limiter (RateLimiter): The object limiting the rate of the
+            requests, shared by all the downloads
+        sid (str): The session id
+        tid (str): The id needed to access the administration panel
+        connections (int): Number of connections made since the creation of
+            the session (used to avoid reconnecting several times when
+            multiple downloads fail simultaneously)
+        latencies (deque(float)): The durations of the last successful
+            requests
     """
     def __init__(self, config):
-        self.logger = logging.getLogger("lalf.session.Session")
+        self.logger = logging.getLogger("{}.{}".format(self.__class__.__module__,
+                                                       self.__class__.__name__))
 
         self.config = config
-        self.session = requests.Session()
         self.sid = None
         self.tid = None
+        self.connections = 0
+
+        if config["http_cache"] or config["offline"]:
+            self.cache = Cache()
+        else:
+            self.cache = None
+
+        self.limiter = RateLimiter(config)
+
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.latencies_lock = threading.Lock()
 
     def url(self, path):
         """
@@ -52,9 +108,9 @@ class Session(object):
         """
         return urlunparse(("http", self.config["url"], path, '', '', ''))
 
-    def _get(self, path, **kwargs):
+    def prepare(self, path, kwargs):
         """
-        Download a file
+        Add the parameters and headers sent with every request to kwargs
         """
         # Set the temporary theme
         if self.config["temporary_theme"] != '' and path[:6] != '/admin':
@@ -69,34 +125,109 @@ class Session(object):
         kwargs["headers"]["User-Agent"] = (
             "Mozilla/5.0 (Windows NT 6.1; WOW64; rv:41.0) Gecko/20100101 Firefox/41.0")
 
-        return self.session.get(self.url(path), **kwargs)
+        return kwargs
 
-    def connect(self):
+    def cache_key(self, path, kwargs):
         """
-        Connect to the forum and initialize session, sid and tid.
+        Returns the key of a request in the cache (or None if the cache is disabled)
+
+        This should be called before prepare, which modifies the parameters.
         """
-        self.logger.debug('Connection au forum')
+        if self.cache is None:
+            return None
+        return self.cache.key(path, kwargs.get("params"))
 
-        # Reset session
-        self.session.close()
-        self.sid = None
-        self.tid = None
+    def cached(self, key, path):
+        """
+        Returns the cached response of a request, or None if the page has to
+        be downloaded
+        """
+        if key is not None:
+            entry = self.cache.get(key)
+            if entry is not None:
+                return make_response(**entry)
 
-        self.session = requests.Session()
-        self.session.keep_alive = False
+        if self.config["offline"]:
+            raise NotInCache(path)
+
+        return None
+
+    def cache_response(self, key, response):
+        """
+        Save a response in the cache (if it is enabled)
+        """
+        if key is not None:
+            self.cache.set(key, response)
+
+    def record_latency(self, latency):
+        """
+        Record the duration of a successful request
+        """
+        with self.latencies_lock:
+            self.latencies.append(latency)
+
+    def hedge_delay(self):
+        """
+        Returns the time after which a request is considered slow and a
+        second identical request should be sent (the hedge_percentile-th
+        percentile of the last latencies), or None if requests should
+        not be hedged
+        """
+        if self.config["hedge_percentile"] <= 0 or self.window <= 1:
+            return None
+
+        with self.latencies_lock:
+            if len(self.latencies) < MIN_LATENCY_SAMPLES:
+                return None
+            latencies = sorted(self.latencies)
+
+        index = int(len(latencies) * min(self.config["hedge_percentile"], 100) / 100)
+        return latencies[min(index, len(latencies) - 1)]
+
+    @staticmethod
+    def throttled(url, response):
+        """
+        Returns True if the forum refused to answer the request for url,
+        either explicitly (status code 429 or 503, or Retry-After header)
+        or by redirecting it to the login page
+        """
+        if response.status_code in (429, 503) or "Retry-After" in response.headers:
+            return True
+
+        return (urlparse(response.url).path == "/login"
+                and urlparse(url).path != "/login")
+
+    @staticmethod
+    def retry_after(response):
+        """
+        Returns the delay (in seconds) given in the Retry-After header of
+        the response, or None
+        """
+        try:
+            return float(response.headers.get("Retry-After"))
+        except (TypeError, ValueError):
+            return None
 
-        # Log in
-        params = {
+    def login_params(self):
+        """
+        Returns the parameters of the login request
+        """
+        return {
             'autologin': 1,
             'login': 'Connexion',
             'password': self.config["admin_password"],
             'username': self.config["admin_name"],
             'redirect': ""}
-        self._get("/login", params=params)
 
-        # Check that the user is connected
+    def set_sid(self, cookies):
+        """
+        Get the sid from the cookies set by the login request
+
+        Parameters :
+        cookies -- iterable of (name, value) pairs
+        """
         self.logger.debug('Récupération du sid')
-        for name, value in self.session.cookies.items():
+        for name, value in cookies:
             if name[-3:] == "sid":
                 self.sid = value
 
@@ -104,15 +235,37 @@ class Session(object):
             self.logger.critical('Échec de la connection.')
             raise UnableToConnect()
 
-        if self.tid is None:
-            self.logger.debug('Récupération du tid')
+    def set_tid(self, url):
+        """
+        Get the tid from the url of the administration panel
+        """
+        try:
+            self.tid = urlparse(url).query.split("=")[1]
+        except IndexError:
+            self.logger.critical('Impossible de récupérer le tid.')
+            raise UnableToConnect()
 
-            response = self._get('/admin/index.forum')
-            try:
-                self.tid = urlparse(response.url).query.split("=")[1]
-            except IndexError:
-                self.logger.critical('Impossible de récupérer le tid.')
-                raise UnableToConnect()
+    def admin_params(self, kwargs):
+        """
+        Add the parameters needed to access the administration panel to kwargs
+        """
+        if "params" not in kwargs:
+            kwargs["params"] = {}
+
+        kwargs["params"]["extended_admin"] = 1
+        kwargs["params"]["tid"] = self.tid
+
+        return kwargs
+
+    def image_url(self, image):
+        """
+        Returns the full url of an image
+        """
+        url = urlparse(image)
+
+        if url.scheme == '' or url.netloc == '':
+            return self.url(image)
+        return image
 
     def connected(self, html=None):
         """
@@ -122,22 +275,178 @@ class Session(object):
         html -- source of the last downloaded page
         """
         if self.sid:
-            if html:
-                document = PyQuery(html)
-                for element in document(".mainmenu"):
-                    if element.get("href", "") == "/login":
+            # Look for a link of the main menu pointing to the login
+            # page (most pages do not contain any link to /login)
+            if html and "/login" in html:
+                for match in LOGIN_HREF.finditer(html):
+                    start = html.rfind("<", 0, match.start())
+                    end = html.find(">", match.end())
+                    if end < 0:
+                        end = len(html)
+                    if start >= 0 and MAINMENU_CLASS.search(html, start, end):
                         return False
             return True
         return False
 
-    def get(self, path, **kwargs):
+class Session(BaseSession):
+    """
+    Object handling the connections to the forum
+
+    Attrs:
+        window (int): The number of pages that can be downloaded in the
+            background while a node is exported (see prefetch)
+        prefetched (Dict(str, Future)): The pages being downloaded in the
+            background, indexed by their path
+        async_session (AsyncSession): The asynchronous session to which
+            the downloads are forwarded, or None (see forward)
+        loop (asyncio.AbstractEventLoop): The event loop of async_session
+    """
+    def __init__(self, config):
+        BaseSession.__init__(self, config)
+
+        self.lock = threading.Lock()
+
+        self.async_session = None
+        self.loop = None
+
+        self.window = config["max_connections"]
+        self.prefetched = {}
+        if self.window > 1:
+            self.executor = ThreadPoolExecutor(max_workers=self.window)
+            # Hedged requests are sent by other threads, so that they
+            # do not wait for the prefetched pages
+            self.hedger = ThreadPoolExecutor(max_workers=2 * self.window)
+        else:
+            self.executor = None
+            self.hedger = None
+
+        # The connections are kept alive and reused by all the threads,
+        # including the hedged requests
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=2 * self.window)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.timeout = (config["connect_timeout"], config["read_timeout"])
+
+    def send(self, url, **kwargs):
         """
-        Download a page of the forum
+        Download a file, respecting the limits of the rate limiter
+        """
+        kwargs.setdefault("timeout", self.timeout)
+
+        start = self.limiter.acquire()
+        try:
+            response = self.session.get(url, **kwargs)
+        except requests.RequestException:
+            # A network error is not a sign of throttling
+            self.limiter.release(start, cancelled=True)
+            raise
+
+        throttled = self.throttled(url, response)
+        self.limiter.release(start, throttled, self.retry_after(response))
+        if not throttled:
+            self.record_latency(time.monotonic() - start)
+        return response
+
+    def request(self, url, hedge=True, **kwargs):
+        """
+        Download a file. If the download takes longer than most of the
+        previous ones (see hedge_delay), the same request is sent again
+        and the first response received is returned.
+        """
+        delay = self.hedge_delay() if hedge else None
+        if delay is None or self.hedger is None:
+            return self.send(url, **kwargs)
+
+        first = self.hedger.submit(self.send, url, **kwargs)
+        if wait([first], timeout=delay).done:
+            return first.result()
+
+        self.logger.debug("Téléchargement lent, envoi d'une seconde requête pour %s", url)
+        pending = {first, self.hedger.submit(self.send, url, **kwargs)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+
+        # Both requests failed
+        return first.result()
+
+    def _get(self, path, hedge=True, **kwargs):
+        """
+        Download a file
+        """
+        return self.request(self.url(path), hedge, **self.prepare(path, kwargs))
+
+    def attempt(self, path, **kwargs):
+        """
+        Download a page of the forum, or return None if the connection
+        failed or timed out
+        """
+        try:
+            return self._get(path, **kwargs)
+        except requests.RequestException as e:
+            self.logger.warning("Échec du téléchargement de %s : %s", path, e)
+            return None
+
+    def connect(self):
+        """
+        Connect to the forum and initialize session, sid and tid.
+        """
+        self.logger.debug('Connection au forum')
+
+        # Forget the previous session id (the connections and the other
+        # cookies are kept)
+        for cookie in list(self.session.cookies):
+            if cookie.name[-3:] == "sid":
+                self.session.cookies.clear(cookie.domain, cookie.path, cookie.name)
+        self.sid = None
+        self.tid = None
+
+        self.connections += 1
+
+        # Log in (the request is not hedged, to get a single session id)
+        self._get("/login", False, params=self.login_params())
+
+        # Check that the user is connected
+        self.set_sid(self.session.cookies.items())
+
+        if self.tid is None:
+            self.logger.debug('Récupération du tid')
+
+            response = self._get('/admin/index.forum', False)
+            self.set_tid(response.url)
+
+    def reconnect(self, connections):
+        """
+        Connect to the forum again, unless another thread already did
+        it since the failed download started
+
+        Parameters :
+        connections -- value of the connections attribute when the
+                       download started
+        """
+        with self.lock:
+            if self.connections == connections:
+                self.connect()
+
+    def download(self, path, **kwargs):
+        """
+        Download a page of the forum, connecting again if necessary
         """
-        response = self._get(path, **kwargs)
+        key = self.cache_key(path, kwargs)
+        response = self.cached(key, path)
+        if response is not None:
+            return response
+
+        connections = self.connections
+        response = self.attempt(path, **kwargs)
 
         failures = 0
-        while response.status_code >= 300 or not self.connected(response.text):
+        while (response is None or response.status_code >= 300
+               or not self.connected(response.text)):
             if failures >= 4:
                 # The connection failed four times, there must be something wrong
                 raise UnableToConnect()
@@ -145,41 +454,120 @@ class Session(object):
 
             if failures >= 2:
                 # The connection failed two times, wait
+                delay = max(self.config["reconnect_delay"], self.limiter.backoff(failures - 1))
                 self.logger.info(
-                    "La connexion a échoué au moins deux fois, attend 30 "
-                    "secondes avant de réessayer.")
-                time.sleep(30)
+                    "La connexion a échoué %d fois, attend %.1f secondes avant de réessayer.",
+                    failures, delay)
+                time.sleep(delay)
 
             try:
-                self.connect()
-            except UnableToConnect:
+                self.reconnect(connections)
+            except (UnableToConnect, requests.RequestException):
+                connections = self.connections
                 continue
-            response = self._get(path, **kwargs)
+            connections = self.connections
+            response = self.attempt(path, **kwargs)
 
+        self.cache_response(key, response)
         return response
 
+    def prefetch(self, path):
+        """
+        Start downloading a page of the forum in the background (if
+        max_connections is greater than 1). The response will be
+        returned by the next call to get with the same path.
+        """
+        if self.executor is None or path in self.prefetched:
+            return
+
+        self.prefetched[path] = self.executor.submit(self.download, path)
+
+    def forward(self, async_session, loop):
+        """
+        Download the pages with an asynchronous session (running in
+        another thread), so that a single session is connected to the
+        forum during the asynchronous export (see Node.export_async)
+
+        Args:
+            async_session (AsyncSession): The session (or None to stop
+                forwarding the downloads)
+            loop (asyncio.AbstractEventLoop): The event loop running it
+        """
+        self.async_session = async_session
+        self.loop = loop
+
+    def run(self, coroutine):
+        """
+        Wait for the result of a coroutine of the asynchronous session
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def cancel(self, paths):
+        """
+        Cancel the downloads started by prefetch for the given paths
+        (None being ignored), if their pages have not been requested
+        """
+        for path in paths:
+            future = self.prefetched.pop(path, None)
+            if future is not None:
+                future.cancel()
+
+    def close(self):
+        """
+        Cancel the downloads waiting to be started, without waiting for
+        the running ones (called when the export fails)
+        """
+        for executor in (self.executor, self.hedger):
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
+        self.prefetched = {}
+
+    def get(self, path, **kwargs):
+        """
+        Download a page of the forum
+        """
+        if not kwargs and path in self.prefetched:
+            return self.prefetched.pop(path).result()
+
+        if self.async_session is not None:
+            return self.run(self.async_session.get(path, **kwargs))
+
+        return self.download(path, **kwargs)
+
+    def store(self, path, response):
+        """
+        Make the next call to get with the same path return response
+        instead of downloading the page (used by the asynchronous export,
+        see lalf.asyncsession)
+        """
+        future = Future()
+        future.set_result(response)
+        self.prefetched[path] = future
+
     def get_admin(self, path, **kwargs):
         """
         Download a page of the forum's administration panel
         """
-        if not self.tid:
-            self.connect()
+        if self.async_session is not None:
+            return self.run(self.async_session.get_admin(path, **kwargs))
 
-        if "params" not in kwargs:
-            kwargs["params"] = {}
-
-        kwargs["params"]["extended_admin"] = 1
-        kwargs["params"]["tid"] = self.tid
+        if not self.tid and not self.config["offline"]:
+            self.connect()
 
-        return self.get(path, **kwargs)
+        return self.get(path, **self.admin_params(kwargs))
 
     def get_image(self, image, **kwargs):
         """
         Download an image
         """
-        url = urlparse(image)
+        if self.async_session is not None:
+            return self.run(self.async_session.get_image(image, **kwargs))
 
-        if url.scheme == '' or url.netloc == '':
-            image = self.url(image)
+        url = self.image_url(image)
+        key = self.cache_key(url, kwargs)
+        response = self.cached(key, url)
+        if response is None:
+            response = self.request(url, **kwargs)
+            self.cache_response(key, response)
 
-        return self.session.get(image, **kwargs)
+        return response
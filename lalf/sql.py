@@ -19,21 +19,104 @@
 Module handling the writing of the sql dump file
 """
 
-import codecs
+import gzip
+import io
+import json
+import os
+
+# Size of the write buffer of the dump files
+BUFFER_SIZE = 1024 * 1024
+
+# Extensions of the dump files, for each value of the dump_compression option
+EXTENSIONS = {"none": "", "gzip": ".gz", "zstd": ".zst"}
+
+# Statements written at the beginning and at the end of the dump file by
+# SqlFile when fast_import is True
+FAST_IMPORT_HEADER = """\
+SET @OLD_UNIQUE_CHECKS=@@UNIQUE_CHECKS, UNIQUE_CHECKS=0;
+SET @OLD_FOREIGN_KEY_CHECKS=@@FOREIGN_KEY_CHECKS, FOREIGN_KEY_CHECKS=0;
+SET @OLD_AUTOCOMMIT=@@AUTOCOMMIT, AUTOCOMMIT=0;
+"""
+
+FAST_IMPORT_FOOTER = """\
+SET UNIQUE_CHECKS=@OLD_UNIQUE_CHECKS;
+SET FOREIGN_KEY_CHECKS=@OLD_FOREIGN_KEY_CHECKS;
+SET AUTOCOMMIT=@OLD_AUTOCOMMIT;
+"""
+
+def open_output(path, compression="none"):
+    """
+    Open a file of the dump for writing, with a large write buffer
+
+    Args:
+        path (str): The path of the file (including the extension of the
+            compression, see EXTENSIONS)
+        compression (str): none, gzip or zstd (which requires python 3.14
+            or the zstandard module)
+
+    Returns:
+        A text file object, encoding the strings in utf-8
+    """
+    if compression == "gzip":
+        binary = io.BufferedWriter(gzip.open(path, "wb", compresslevel=6), BUFFER_SIZE)
+    elif compression == "zstd":
+        binary = io.BufferedWriter(open_zstd(path), BUFFER_SIZE)
+    else:
+        binary = open(path, "wb", buffering=BUFFER_SIZE)
+
+    # The line endings are not translated
+    return io.TextIOWrapper(binary, encoding="utf-8", newline="")
+
+def open_zstd(path):
+    """
+    Open a file compressed with zstd for writing
+    """
+    try:
+        from compression import zstd
+        return zstd.open(path, "wb")
+    except ImportError:
+        # Older versions of python
+        import zstandard
+        return zstandard.ZstdCompressor().stream_writer(open(path, "wb"))
 
 def escape(string):
     """
     Escapes special characters in a string for use in an SQL statement
     """
-    return string.replace("\\", "\\\\").replace("'", "''")
+    # Most of the strings do not contain any special character
+    if "'" in string or "\\" in string:
+        return string.replace("\\", "\\\\").replace("'", "''")
+    return string
 
 class SqlFile(object):
     """
     Object used to save sql queries in an sql file
 
+    The rows inserted in a table are buffered, and written as a single
+    insert statement when the next row would make it longer than
+    max_packet bytes, when the columns change, or before any other
+    statement. The rows of a table are thus inserted in the same order
+    as with one statement per row.
+
+    If fast_import is True, the unique and foreign key checks are
+    disabled during the import, as well as the non-unique indexes of the
+    tables (which are rebuilt at the end). Each sequence of statements
+    modifying the same table is committed as a single transaction. With
+    InnoDB (the default engine of phpbb), the unique and foreign key
+    checks and the transactions are what speed up the import:
+    ALTER TABLE ... DISABLE KEYS only has an effect on MyISAM tables, and
+    is ignored (with a warning) by InnoDB.
+
     Attrs:
         path (str): The path of the sql dump file
         prefix (str): A prefix that will be added before the table names
+        max_packet (int): The maximal length (in bytes) of an insert
+            statement containing several rows (0 to write one statement
+            per row)
+        fast_import (bool): Whether the statements speeding up the
+            import should be added (MySQL only)
+        compression (str): The compression of the dump file (see
+            open_output)
 
     Example:
         >>> with SqlFile("phpbb.sql", "phpbb_"):
@@ -44,16 +127,97 @@ class SqlFile(object):
         ...         # ...
         ...     })
     """
-    def __init__(self, path, prefix=""):
-        self.fileobj = codecs.open(path, "w", "utf-8")
+    def __init__(self, path, prefix="", max_packet=0, fast_import=False, compression="none"):
+        self.fileobj = open_output(path, compression)
         self.prefix = prefix
+        self.max_packet = max_packet
+        self.fast_import = fast_import
+        self.compression = compression
+
+        # Rows waiting to be written, for each table: [columns, rows, length
+        # of the statement]
+        self.buffers = {}
+
+        # Table modified by the current transaction (see write)
+        self.table = None
+
+        # Tables whose indexes are disabled
+        self.disabled_keys = []
+
+        if self.fast_import:
+            self.fileobj.write(FAST_IMPORT_HEADER)
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Write the buffered rows and close the dump file
+        """
+        self.flush()
+
+        if self.fast_import:
+            self.fileobj.write("COMMIT;\n")
+            for table in self.disabled_keys:
+                self.fileobj.write("ALTER TABLE {}{} ENABLE KEYS;\n".format(self.prefix, table))
+            self.fileobj.write(FAST_IMPORT_FOOTER)
+
         self.fileobj.close()
 
+    def write(self, table, statement):
+        """
+        Write a statement modifying a table in the dump file
+        """
+        if self.fast_import and table != self.table:
+            # Commit the statements modifying the previous table
+            if self.table is not None:
+                self.fileobj.write("COMMIT;\n")
+            self.table = table
+
+        self.fileobj.write(statement)
+
+    def write_insert(self, table, columns, rows):
+        """
+        Write an insert statement in the dump file
+
+        Attrs:
+            table (str):
+            columns (str): The names of the columns, separated by commas
+            rows (str): The values of the rows, separated by commas
+        """
+        if self.fast_import and table not in self.disabled_keys:
+            self.disable_keys(table)
+
+        self.write(table, 'INSERT INTO {prefix}{table} ({columns}) VALUES {rows};\n'.format(
+            prefix=self.prefix,
+            table=table,
+            columns=columns,
+            rows=rows))
+
+    def disable_keys(self, table):
+        """
+        Disable the non-unique indexes of a table until the end of the import
+        (MyISAM tables only, see the docstring of the class)
+        """
+        self.write(table, "ALTER TABLE {}{} DISABLE KEYS;\n".format(self.prefix, table))
+        self.disabled_keys.append(table)
+
+    def flush(self, table=None):
+        """
+        Write the rows buffered for a table (or for all the tables)
+        """
+        if table is None:
+            tables = list(self.buffers)
+        else:
+            tables = [table]
+
+        for table in tables:
+            columns, rows, _ = self.buffers.pop(table)
+            self.write_insert(table, columns, ",\n".join(rows))
+
     def insert(self, table, entry):
         """
         Add an insert statement to the dump file
@@ -62,32 +226,209 @@ class SqlFile(object):
             table (str):
             entry (dict): Dictionnary associating column names to their values
         """
-        columns = []
         values = []
-        for column, value in entry.items():
-            columns.append(column)
-            values.append("'{}'".format(escape(str(value))))
+        for value in entry.values():
+            if value.__class__ is int:
+                # The integers (most of the columns) do not need to be escaped
+                values.append("'{}'".format(value))
+            else:
+                values.append("'{}'".format(escape(str(value))))
 
-        self.fileobj.write('INSERT INTO {prefix}{table} ({columns}) VALUES ({values});\n'.format(
-            prefix=self.prefix,
-            table=table,
-            columns=", ".join(columns),
-            values=", ".join(values)))
+        columns = ", ".join(entry)
+        row = "({})".format(", ".join(values))
+
+        if self.max_packet <= 0:
+            self.write_insert(table, columns, row)
+            return
+
+        # Length of the row in the statement, in bytes (most of the rows
+        # do not need to be encoded)
+        if row.isascii():
+            length = len(row) + 2
+        else:
+            length = len(row.encode("utf-8")) + 2
+
+        buf = self.buffers.get(table)
+        if buf is not None and (buf[0] != columns or buf[2] + length > self.max_packet):
+            self.flush(table)
+            buf = None
+
+        if buf is None:
+            # Each row is followed by ",\n", or by ";\n" for the last one
+            header = "INSERT INTO {}{} ({}) VALUES ".format(self.prefix, table, columns)
+            buf = self.buffers[table] = [columns, [], len(header.encode("utf-8"))]
+
+        buf[1].append(row)
+        buf[2] += length
 
     def truncate(self, table):
         """
         Add truncate statement to the dump file
         """
+        self.flush()
         self.fileobj.write('TRUNCATE TABLE {prefix}{table};\n'.format(
             prefix=self.prefix,
             table=table))
 
+        # TRUNCATE commits the current transaction
+        self.table = None
+
     def set_config(self, name, value):
         """
         Update a value in the phpbb_config table
         """
-        self.fileobj.write(
+        self.flush()
+        self.write(
+            "config",
             "UPDATE {prefix}config SET config_value='{value}' WHERE config_name='{name}';\n".format(
                 prefix=self.prefix,
                 value=escape(str(value)),
                 name=escape(name)))
+
+class ShardedSqlFile(SqlFile):
+    """
+    Object used to save sql queries in several sql files (shards), which
+    can be imported concurrently
+
+    The TRUNCATE statements (and the statements disabling the indexes)
+    are written in init.sql, the rows of each table in
+    <prefix><table>.<n>.sql (a new shard being started when the next
+    statement would make the current one larger than shard_size
+    bytes), and the statements updating the configuration (and
+    rebuilding the indexes) in finish.sql. The extension of the
+    compression (see EXTENSIONS) is added to the names of these files.
+
+    The shards of the tables can be imported in any order, by several
+    clients, once init.sql has been imported. finish.sql has to be
+    imported last. These dependencies are described in manifest.json.
+
+    Attrs:
+        path (str): The directory in which the shards are written
+        shard_size (int): The size (in bytes) of the statements of
+            each shard of the tables (a shard contains at least one
+            statement)
+    """
+    def __init__(self, path, prefix="", max_packet=0, fast_import=False, shard_size=0,
+                 compression="none"):
+        os.makedirs(path, exist_ok=True)
+        self.extension = EXTENSIONS[compression]
+        SqlFile.__init__(self, os.path.join(path, "init.sql" + self.extension), prefix,
+                         max_packet, fast_import, compression)
+        self.path = path
+        self.shard_size = shard_size
+
+        # Current shard of each table: [file object, size]
+        self.shards = {}
+
+        # Number of shards of each table
+        self.counts = {}
+
+        # Names of the shards of the tables, in the order in which they
+        # were started
+        self.filenames = []
+
+        # Statements of finish.sql
+        self.final = []
+
+    def close(self):
+        """
+        Write the buffered rows, close the shards and write finish.sql
+        and manifest.json
+        """
+        self.flush()
+
+        for fileobj, _ in self.shards.values():
+            self.close_shard(fileobj)
+        self.shards = {}
+        self.close_shard(self.fileobj)
+
+        finish = "finish.sql" + self.extension
+        with open_output(os.path.join(self.path, finish), self.compression) as fileobj:
+            if self.fast_import:
+                fileobj.write(FAST_IMPORT_HEADER)
+            fileobj.writelines(self.final)
+            for table in self.disabled_keys:
+                fileobj.write("ALTER TABLE {}{} ENABLE KEYS;\n".format(self.prefix, table))
+            if self.fast_import:
+                fileobj.write("COMMIT;\n")
+                fileobj.write(FAST_IMPORT_FOOTER)
+
+        init = "init.sql" + self.extension
+        manifest = {
+            "shards": [{"file": init, "depends": []}] + [
+                {"file": filename, "depends": [init]} for filename in self.filenames
+            ] + [{"file": finish, "depends": self.filenames}]
+        }
+        with open_output(os.path.join(self.path, "manifest.json")) as fileobj:
+            json.dump(manifest, fileobj, indent=4)
+
+    def open_shard(self, table):
+        """
+        Start a new shard of a table
+        """
+        count = self.counts.get(table, 0) + 1
+        self.counts[table] = count
+
+        filename = "{}{}.{}.sql{}".format(self.prefix, table, count, self.extension)
+        self.filenames.append(filename)
+
+        fileobj = open_output(os.path.join(self.path, filename), self.compression)
+        if self.fast_import:
+            fileobj.write(FAST_IMPORT_HEADER)
+        return fileobj
+
+    def close_shard(self, fileobj):
+        """
+        Close a shard (or init.sql)
+        """
+        if self.fast_import:
+            fileobj.write("COMMIT;\n")
+            fileobj.write(FAST_IMPORT_FOOTER)
+        fileobj.close()
+
+    def write(self, table, statement):
+        # The configuration is updated once all the rows are inserted
+        if table == "config":
+            self.final.append(statement)
+            return
+
+        # Length of the statement in bytes (see SqlFile.insert)
+        if statement.isascii():
+            length = len(statement)
+        else:
+            length = len(statement.encode("utf-8"))
+
+        shard = self.shards.get(table)
+        if shard is None or 0 < shard[1] and shard[1] + length > self.shard_size:
+            if shard is not None:
+                self.close_shard(shard[0])
+            shard = self.shards[table] = [self.open_shard(table), 0]
+
+        shard[0].write(statement)
+        shard[1] += length
+
+    def disable_keys(self, table):
+        # The indexes are disabled before any shard is imported
+        self.fileobj.write("ALTER TABLE {}{} DISABLE KEYS;\n".format(self.prefix, table))
+        self.disabled_keys.append(table)
+
+def open_dump(config):
+    """
+    Returns the object in which the forum is dumped (a SqlFile, a
+    ShardedSqlFile if shard_size is set, or a BulkFile if dump_format is
+    tsv)
+    """
+    if config["dump_format"] == "tsv":
+        # lalf.bulk depends on this module
+        from lalf.bulk import BulkFile
+        return BulkFile("phpbb_tsv", config["table_prefix"])
+
+    compression = config["dump_compression"]
+
+    if config["shard_size"] > 0:
+        return ShardedSqlFile("phpbb_sql", config["table_prefix"], config["max_allowed_packet"],
+                              config["fast_import"], config["shard_size"] * 1024 * 1024,
+                              compression)
+
+    return SqlFile("phpbb.sql" + EXTENSIONS[compression], config["table_prefix"],
+                   config["max_allowed_packet"], config["fast_import"], compression)
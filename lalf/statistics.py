@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Lalf.
+#
+# Lalf is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Lalf is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Lalf.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Module computing the statistics needed by the dump
+"""
+
+from lalf.users import AnonymousUser
+
+class UserStatistics(object):
+    """
+    Statistics of the posts of a user
+
+    Attrs:
+        num_posts (int): The number of posts of the user
+        lastpost_time (int): The time of the last post of the user (or 0)
+    """
+    def __init__(self):
+        self.num_posts = 0
+        self.lastpost_time = 0
+
+    def add_post(self, post):
+        """
+        Take a post of the user into account
+        """
+        self.num_posts += 1
+        self.lastpost_time = max(self.lastpost_time, post.time)
+
+class ForumStatistics(object):
+    """
+    Statistics of the topics of a forum (without its subforums)
+
+    Attrs:
+        num_topics (int): The number of topics of the forum
+        num_posts (int): The number of posts of the forum
+        last_post (Post): The most recent post of the forum (or None)
+    """
+    def __init__(self):
+        self.num_topics = 0
+        self.num_posts = 0
+        self.last_post = None
+
+    def add_post(self, post):
+        """
+        Take a post of the forum into account
+        """
+        self.num_posts += 1
+        if self.last_post is None or post.time > self.last_post.time:
+            self.last_post = post
+
+class TopicStatistics(object):
+    """
+    Statistics of the posts of a topic
+
+    Attrs:
+        replies (int): The number of replies (posts except the first one)
+        posters (Set(int)): The new ids of the users who posted in the topic
+    """
+    def __init__(self):
+        self.replies = -1
+        self.posters = set()
+
+    def add_post(self, post):
+        """
+        Take a post of the topic into account
+        """
+        self.replies += 1
+        self.posters.add(post.poster.newid)
+
+class Statistics(object):
+    """
+    Statistics of the exported forum, computed by going through all the
+    posts once (see add_topic), so that the nodes do not have to go
+    through the posts of the whole forum when they are dumped
+
+    Attrs:
+        num_posts (int): The total number of posts
+        num_topics (int): The total number of topics
+        users (Dict(User, UserStatistics)): The statistics of each user
+        anonymous (UserStatistics): The statistics of the posts of
+            users whose new id is 1 (the anonymous user)
+        forums (Dict(Forum, ForumStatistics)): The statistics of each forum
+        topics (Dict(Topic, TopicStatistics)): The statistics of each topic
+    """
+    def __init__(self):
+        self.num_posts = 0
+        self.num_topics = 0
+        self.users = {}
+        self.anonymous = UserStatistics()
+        self.forums = {}
+        self.topics = {}
+
+    def add_topic(self, forum, topic):
+        """
+        Take a topic and its posts into account
+        """
+        self.num_topics += 1
+
+        forum_stats = self.forum(forum)
+        forum_stats.num_topics += 1
+
+        topic_stats = self.topics[topic] = TopicStatistics()
+
+        for post in topic.get_posts():
+            self.num_posts += 1
+            forum_stats.add_post(post)
+            topic_stats.add_post(post)
+
+            if post.poster.newid == 1:
+                self.anonymous.add_post(post)
+            if not isinstance(post.poster, AnonymousUser):
+                self.user(post.poster).add_post(post)
+
+    def forum(self, forum):
+        """
+        Returns the statistics of a forum
+        """
+        try:
+            return self.forums[forum]
+        except KeyError:
+            stats = self.forums[forum] = ForumStatistics()
+            return stats
+
+    def user(self, user):
+        """
+        Returns the statistics of a user
+        """
+        try:
+            return self.users[user]
+        except KeyError:
+            stats = self.users[user] = UserStatistics()
+            return stats
+
+    @classmethod
+    def compute(cls, bb):
+        """
+        Returns the statistics of the forum exported in bb (a BB node)
+        """
+        stats = cls()
+        for forum in bb.forums.values():
+            stats.forum(forum)
+            for topic in forum.get_topics():
+                stats.add_topic(forum, topic)
+        return stats
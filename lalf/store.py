@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Lalf.
+#
+# Lalf is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Lalf is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Lalf.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Module handling the storage of the content of the posts in a SQLite
+database, so that it does not have to be kept in memory
+
+Only the content of the posts, which is most of the memory used by the
+tree, is stored in the database. The other attributes of the nodes
+(titles, dates, posters, ...) stay in the tree, which is still saved in
+save.pickle, except for the pages of the topics which have already been
+written in the dump file with the stream_dump option (see
+Topic.release).
+"""
+
+import os
+import sqlite3
+import threading
+
+STORE_FILE = "save.sqlite"
+
+class Store(object):
+    """
+    SQLite database containing the content of the exported posts, and
+    the pages of the released topics
+
+    The posts are written in the database when they are exported (see
+    Post._export_) and read when they are dumped. The changes are
+    committed before each snapshot of the tree (see lalf.journal), so
+    that the snapshot never refers to posts which are not in the
+    database.
+
+    The pages of the topics released by the thread of lalf.pipeline are
+    committed immediately, since the snapshots refer to them as soon as
+    they are released.
+
+    The posts may be read by the thread of lalf.pipeline while new ones
+    are written, so the connection is protected by a lock.
+
+    Attrs:
+        filename (str): The path of the database
+    """
+    def __init__(self, filename=STORE_FILE):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS posts (
+                post_id INTEGER PRIMARY KEY,
+                topic_id INTEGER NOT NULL,
+                poster_id INTEGER NOT NULL,
+                text TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS posts_topic ON posts (topic_id);
+            CREATE INDEX IF NOT EXISTS posts_poster ON posts (poster_id);
+            CREATE TABLE IF NOT EXISTS topics (
+                topic_id INTEGER PRIMARY KEY,
+                pages BLOB NOT NULL
+            );
+        """)
+
+    def set_text(self, post_id, topic_id, poster_id, text):
+        """
+        Save the content of a post
+        """
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO posts (post_id, topic_id, poster_id, text) "
+                "VALUES (?, ?, ?, ?)", (post_id, topic_id, poster_id, text))
+
+    def add_texts(self, rows):
+        """
+        Save the content of the posts which are not in the database yet
+
+        Args:
+            rows (list): (post_id, topic_id, poster_id, text) tuples
+        """
+        with self.lock:
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO posts (post_id, topic_id, poster_id, text) "
+                "VALUES (?, ?, ?, ?)", rows)
+
+    def get_text(self, post_id):
+        """
+        Returns the content of a post
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT text FROM posts WHERE post_id = ?", (post_id,)).fetchone()
+        if row is None:
+            raise KeyError(post_id)
+        return row[0]
+
+    def set_topic(self, topic_id, pages):
+        """
+        Save the pages of a released topic (pickled by
+        lalf.journal.dumps_nodes) and commit
+        """
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO topics (topic_id, pages) VALUES (?, ?)",
+                (topic_id, pages))
+            self.connection.commit()
+
+    def get_topic(self, topic_id):
+        """
+        Returns the pickled pages of a released topic
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT pages FROM topics WHERE topic_id = ?", (topic_id,)).fetchone()
+        if row is None:
+            raise KeyError(topic_id)
+        return row[0]
+
+    def commit(self):
+        """
+        Write the changes in the database
+        """
+        with self.lock:
+            self.connection.commit()
+
+    def close(self):
+        """
+        Commit the changes and close the database
+        """
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+
+def open_store(config, used=False):
+    """
+    Returns the store of the posts if it is enabled (by the use_sqlite
+    or stream_dump options), else None
+
+    Args:
+        config (Dict): The configuration
+        used (bool): True if the content of the posts of the loaded
+            tree has been saved in the store by a previous run (see
+            BB.uses_store), False if a new exportation is started (the
+            database left by a previous exportation is then removed),
+            or None if it is unknown (trees saved by older versions)
+    """
+    if used is None:
+        used = os.path.isfile(STORE_FILE)
+    elif not used and os.path.isfile(STORE_FILE):
+        os.remove(STORE_FILE)
+    if config["use_sqlite"] or config["stream_dump"] or used:
+        return Store()
+    return None
@@ -18,7 +18,8 @@
 import re
 from pyquery import PyQuery
 
-from lalf.node import Node
+from lalf.node import Node, JOURNAL
+from lalf.journal import dumps_nodes, loads_nodes
 from lalf.posts import TopicPage
 from lalf.util import pages, clean_url
 
@@ -43,9 +44,16 @@ class Topic(Node):
         title (str): The title of the topic
         locked (int): 1 if the topic is locked, else 0
         views (int): The number of views of the topic
+        released (bool): True if the pages of the topic have been moved
+            to the store once written in the dump file (see release)
     """
     # Attributes to save
-    STATE_KEEP = ["topic_id", "topic_type", "title", "locked", "views"]
+    __slots__ = ["topic_id", "topic_type", "title", "locked", "views", "released"]
+
+    STATE_KEEP = ["topic_id", "topic_type", "title", "locked", "views", "released"]
+    STATE_DEFAULTS = {"released": False}
+
+    CHECKPOINT = JOURNAL
 
     def __init__(self, topic_id, topic_type, title, locked, views):
         Node.__init__(self)
@@ -54,6 +62,7 @@ class Topic(Node):
         self.title = title
         self.locked = locked
         self.views = views
+        self.released = False
 
     def _export_(self):
         self.logger.info('Récupération du sujet %d', self.topic_id)
@@ -61,23 +70,76 @@ class Topic(Node):
         self.root.current_topics += 1
         self.ui.update()
 
-        response = self.session.get("/t{}-a".format(self.topic_id))
+        response = self.session.get(self._path_())
         for page in pages(response.text):
-            self.add_child(TopicPage(page))
+            if page == 0:
+                # The first page has just been downloaded
+                self.add_child(TopicPage(page, response.text))
+            else:
+                self.add_child(TopicPage(page))
+
+    def _path_(self):
+        return "/t{}-a".format(self.topic_id)
 
     def get_posts(self):
         """
         Iterator on the posts of the topic
         """
-        for page in self.children:
+        pages = self.children
+        if self.released and not pages:
+            pages = self.load_pages()
+
+        for page in pages:
             for post in page.children:
                 yield post
 
+    def release(self):
+        """
+        Drop the pages of the topic once it has been written in the dump
+        file by the pipeline, saving them in the store first, so that
+        they can be dumped again if the exportation is resumed (see
+        restore)
+        """
+        if not self.released:
+            self.root.store.set_topic(self.topic_id, dumps_nodes(self.root, self.children))
+            self.released = True
+        self.children = ()
+
+    def restore(self):
+        """
+        Load the pages of a released topic from the store
+        """
+        if self.released and not self.children:
+            self.children = self.load_pages()
+
+    def load_pages(self):
+        """
+        Returns the pages of a released topic, read from the store
+        """
+        pages = loads_nodes(self.root, self.root.store.get_topic(self.topic_id))
+        scope = self.child_scope()
+        for page in pages:
+            page.set_scope(scope)
+        return pages
+
+    def _finish_(self):
+        if self.root.pipeline is not None:
+            self.root.pipeline.put(self)
+
+    def dump(self, sqlfile):
+        # The topic has already been written by the pipeline
+        if self.root.pipeline is None:
+            self.restore()
+            Node.dump(self, sqlfile)
+            if self.released:
+                self.release()
+
     def _dump_(self, sqlfile):
         first_post = self.children[0].children[0]
         last_post = self.children[-1].children[-1]
 
-        replies = sum(1 for _ in self.get_posts()) - 1
+        stats = self.root.stats.topics[self]
+        replies = stats.replies
 
         sqlfile.insert("topics", {
             "topic_id" : self.topic_id,
@@ -101,7 +163,7 @@ class Topic(Node):
             "topic_last_post_time" : last_post.time
         })
 
-        for user_id in set(post.poster.newid for post in self.get_posts()):
+        for user_id in stats.posters:
             sqlfile.insert("topics_posted", {
                 "user_id" : user_id,
                 "topic_id" : self.topic_id,
@@ -114,20 +176,30 @@ class ForumPage(Node):
 
     Attrs:
         page (int): The index of the first topic of the page
+        html (str): The source of the page, if it has already been
+            downloaded (it is dropped once the page is exported)
     """
     # Attributes to save
-    STATE_KEEP = ["page"]
+    __slots__ = ["page", "html"]
+
+    STATE_KEEP = ["page", "html"]
+    STATE_DEFAULTS = {"html": None}
+
+    CHECKPOINT = JOURNAL
 
-    def __init__(self, page):
+    def __init__(self, page, html=None):
         Node.__init__(self)
         self.page = page
+        self.html = html
 
     def _export_(self):
         self.logger.debug('Récupération du forum %s (page %d)', self.forum.oldid, self.page)
 
-        # Download the page
-        response = self.session.get("/{}p{}-a".format(self.forum.oldid, self.page))
-        document = PyQuery(response.text)
+        if self.html is None:
+            # Download the page
+            self.html = self.session.get(self._path_()).text
+        document = PyQuery(self.html)
+        self.html = None
 
         # Get the topics
         for element in document.find('div.topictitle'):
@@ -142,6 +214,21 @@ class ForumPage(Node):
                 title = e("a").text()
 
                 self.add_child(Topic(topic_id, topic_type, title, locked, views))
+                self.root.index_topic(topic_id, self.forum.newid)
                 if topic_type >= 2:
                     # The topic is an announcement, save its id to avoid exporting it again
                     self.announcements.append(topic_id)
+
+    def _path_(self):
+        if self.html is not None:
+            return None
+        return "/{}p{}-a".format(self.forum.oldid, self.page)
+
+    def _journal_(self):
+        # Announcements added to the list of the exported announcements
+        return [topic.topic_id for topic in self.children if topic.topic_type >= 2]
+
+    def _replay_(self, data):
+        for topic_id in data:
+            if topic_id not in self.announcements:
+                self.announcements.append(topic_id)
@@ -103,12 +103,9 @@ class AnonymousUser(Node):
         self.colour = ""
 
     def _dump_(self, sqlfile):
-        post_times = [post.time for post in self.root.get_posts() if post.poster.newid == 1]
-        num_posts = sum(1 for _ in post_times)
-        if num_posts > 0:
-            lastpost_time = max(post_times)
-        else:
-            lastpost_time = 0
+        stats = self.root.stats.anonymous
+        num_posts = stats.num_posts
+        lastpost_time = stats.lastpost_time
 
         sqlfile.insert("users", {
             "user_id" : "1",
@@ -180,22 +177,25 @@ class User(Node):
         """
         return
 
+    def update_colour(self):
+        """
+        Set the colour of the user according to its groups
+        """
+        if 5 in [group.newid for group in self.groups]:
+            # The user is an administrator
+            self.colour = "AA0000"
+
     def _dump_(self, sqlfile):
         try:
             group_id = self.groups[0].newid
         except:
             group_id = 2
 
-        if 5 in [group.newid for group in self.groups]:
-            # The user is an administrator
-            self.colour = "AA0000"
+        self.update_colour()
 
-        post_times = [post.time for post in self.root.get_posts() if post.poster == self]
-        num_posts = sum(1 for _ in post_times)
-        if num_posts > 0:
-            lastpost_time = max(post_times)
-        else:
-            lastpost_time = 0
+        stats = self.root.stats.user(self)
+        num_posts = stats.num_posts
+        lastpost_time = stats.lastpost_time
 
         user = {
             "user_id" : self.newid,
@@ -46,6 +46,7 @@ setup(
     packages=['lalf'],
     install_requires=[
         'pyquery',
+        'lxml',
         'requests',
         'Pillow'
     ],